@@ -0,0 +1,40 @@
+"""Utility functions for working with PrettyMIDI objects."""
+
+from pysong.song_elements import TimeSignature
+
+
+# Tolerance in seconds when comparing PrettyMIDI times, which are floats.
+_EPSILON = 1e-9
+
+
+def get_all_time_signatures(midi, downbeats=None):
+    """Returns a list with the TimeSignature of each measure of a PrettyMIDI object.
+
+    params:
+        midi: a PrettyMIDI object.
+        downbeats: the start time of each measure. Defaults to midi.get_downbeats().
+
+    returns: the TimeSignature in effect at each downbeat, which is 4/4 before the first time
+             signature change.
+    """
+    if downbeats is None:
+        downbeats = midi.get_downbeats()
+    changes = sorted(midi.time_signature_changes, key=lambda change: change.time)
+
+    time_signatures = []
+    time_signature = TimeSignature()
+    change_idx = 0
+    for downbeat in downbeats:
+        while change_idx < len(changes) and changes[change_idx].time <= downbeat + _EPSILON:
+            change = changes[change_idx]
+            time_signature = TimeSignature(change.numerator, change.denominator)
+            change_idx += 1
+        time_signatures.append(time_signature)
+    return time_signatures
+
+
+def is_monophonic(instrument):
+    """Returns True if no two notes of the pretty_midi Instrument sound at the same time."""
+    notes = sorted(instrument.notes, key=lambda note: note.start)
+    return all(note.end <= next_note.start + _EPSILON
+               for note, next_note in zip(notes, notes[1:]))
@@ -3,6 +3,7 @@
 # Requires the following pacakges:
 #   * mido        -- for MIDI export
 #   * pretty_midi -- for MIDI import
+#   * numpy       -- for bulk operations on notes (also required by pretty_midi)
 #
 # Install:
 #   pip install pretty_midi    (includes mido)
@@ -13,12 +14,129 @@
 
 import gzip
 import pickle
+from itertools import islice
+from numbers import Integral
 
-from pysong.song_elements import Track, TimeSignature, Key, TrackType
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+from pysong.song_elements import NOTE_DTYPE, Track, TimeSignature, Key, Mode, TrackType
+
+
+# Row types of the arrays in a saved song, one row per track, measure and event respectively. The
+# notes are saved as the pitch, velocity and tie columns of Track.note_array.
+_TRACK_DTYPE = np.dtype([('program', 'i4'), ('channel', 'i4'), ('track_type', 'i1'),
+                         ('num_measures', 'i8')])
+_MEASURE_DTYPE = np.dtype([('start_tick', 'i8'), ('numerator', 'i4'), ('denominator', 'i4'),
+                           ('num_events', 'i8')])
+_EVENT_DTYPE = np.dtype([('duration', 'i8'), ('num_notes', 'i4')])
+
+# Every .npz file is a zip archive, which starts with a local file header.
+_NPZ_MAGIC = b'PK\x03\x04'
+
+# Classes that earlier versions pickled as plain attribute dicts, before they had __slots__.
+_LEGACY_CLASSES = frozenset([('pysong.song', 'Song'), ('pysong.song_elements', 'TimeSignature'),
+                             ('pysong.song_elements', 'Key'), ('pysong.song_elements', 'Track'),
+                             ('pysong.song_elements', 'Measure'),
+                             ('pysong.song_elements', 'Event'), ('pysong.song_elements', 'Note')])
+
+
+def _is_npz(file):
+    """Returns True if the file (a path or a seekable binary file object) starts like an .npz
+    file. Leaves the position of a file object unchanged."""
+    if hasattr(file, 'read'):
+        start = file.tell()
+        magic = file.read(len(_NPZ_MAGIC))
+        file.seek(start)
+    else:
+        with open(file, 'rb') as f:
+            magic = f.read(len(_NPZ_MAGIC))
+    return magic == _NPZ_MAGIC
+
+
+class _LegacyObject:
+    """Stand-in for the pysong classes when unpickling songs saved by earlier versions: keeps the
+    pickled attributes, from which _song_from_legacy builds the actual objects."""
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Unpickler for songs saved as gzipped pickles by earlier versions."""
+
+    def find_class(self, module, name):
+        if (module, name) in _LEGACY_CLASSES:
+            return _LegacyObject
+        return super().find_class(module, name)
+
+
+def _song_from_legacy(legacy_song):
+    """Returns a Song built from the _LegacyObject tree of a song saved by earlier versions."""
+    song = Song(legacy_song.name, legacy_song.ticks_per_beat)
+    song.time_signature = TimeSignature(legacy_song.time_signature.numerator,
+                                        legacy_song.time_signature.denominator)
+    song.key = Key(legacy_song.key.tonic_pitch_class, mode=legacy_song.key.mode)
+    song.time_signature_changes = legacy_song.time_signature_changes
+    for legacy_track in legacy_song.tracks:
+        track = song.new_track(legacy_track.name, legacy_track.program, legacy_track.channel,
+                               legacy_track.track_type)
+        for legacy_measure in legacy_track.measures:
+            time_signature = legacy_measure.time_signature
+            measure = track.new_measure(TimeSignature(time_signature.numerator,
+                                                      time_signature.denominator))
+            measure.start_tick = legacy_measure.start_tick
+            for legacy_event in legacy_measure.events:
+                event = measure.new_event(legacy_event.duration)
+                for note in legacy_event.notes:
+                    event.new_note(note.midi_pitch, note.velocity, note.tie_from_previous)
+    return song
+
+
+def _check_name(name):
+    """Raises TypeError unless name is a valid Song or Track name for Song.save: a str or None."""
+    if name is not None and not isinstance(name, str):
+        raise TypeError('Song and track names must be str or None, not %r' % (name,))
+
+
+def _time_signature_changes_array(time_signature_changes):
+    """Returns the time signature changes as an int64 array with a row per change. Raises
+    ValueError unless each change is a (tick, numerator, denominator) tuple of ints."""
+    for change in time_signature_changes:
+        if not (isinstance(change, (tuple, list)) and len(change) == 3
+                and all(isinstance(value, Integral) for value in change)):
+            raise ValueError('time_signature_changes must hold (tick, numerator, denominator) '
+                             'tuples of ints, not %r' % (change,))
+    return np.array(time_signature_changes, dtype=np.int64).reshape(-1, 3)
+
+
+def _sounding_in_previous_event(pitches, event_sizes):
+    """Given the MIDI pitches of all notes in a run of consecutive events, and the number of notes
+    in each event, returns a boolean array that is True for each note whose pitch also occurs in
+    the previous event.
+
+    Each event's pitches are stored as a 128-bit set in two uint64 words, so that each membership
+    test is a single shift and mask."""
+    event_indices = np.repeat(np.arange(len(event_sizes)), event_sizes)
+    pitches = pitches.astype(np.int64)
+    word_indices = pitches >> 6
+    bits = np.left_shift(np.uint64(1), (pitches & 63).astype(np.uint64))
+    # Row i + 1 holds the pitch set of event i; row 0 is an empty set before the first event.
+    pitch_sets = np.zeros((len(event_sizes) + 1, 2), dtype=np.uint64)
+    np.bitwise_or.at(pitch_sets, (event_indices + 1, word_indices), bits)
+    return (pitch_sets[event_indices, word_indices] & bits) != 0
+
+
+def _track_key(track):
+    """Sort key for a Track: its metadata, including the number of measures. Tracks named None
+    sort after the others, so that they can be sorted together with str-named tracks."""
+    name = track.name
+    return (name is None, name or '', track.program, track.channel, int(track.track_type),
+            len(track.measures))
 
 
 class Song:
     """Stores an entire symbolic score for a song. Contains multiple tracks."""
+    __slots__ = ('name', 'time_signature', 'key', 'tracks', 'ticks_per_beat',
+                 'time_signature_changes')
+
     def __init__(self, name='', ticks_per_beat=480): #TODO: add other params (midi_path, h5_path, original key?)
         self.name = name
         self.time_signature = TimeSignature()
@@ -42,20 +160,33 @@ class Song:
         return iter(self.tracks)
 
     def __eq__(self, s2):
-        if not (isinstance(s2, Song) and
-                self.name == s2.name and
+        if s2.__class__ is not Song:
+            return NotImplemented
+        tracks1 = self.tracks
+        tracks2 = s2.tracks
+        num_tracks = len(tracks1)
+        if not (self.name == s2.name and
                 self.time_signature == s2.time_signature and
                 self.key == s2.key and
-                len(self.tracks) == len(s2.tracks) and
+                num_tracks == len(tracks2) and
                 self.ticks_per_beat == s2.ticks_per_beat):
             return False
         # Verify all tracks from self show up in s2. order does not matter; allow permutations.
-        for track in self.tracks:
-            for track2 in s2.tracks:
-                if track == track2:
-                    break
-            else:
-                return False
+        # Sort both track lists by their metadata so that only tracks with identical metadata
+        # need to be searched for a match.
+        tracks1 = sorted(tracks1, key=_track_key)
+        tracks2 = sorted(tracks2, key=_track_key)
+        keys = [_track_key(track) for track in tracks1]
+        if keys != [_track_key(track) for track in tracks2]:
+            return False
+        start = 0
+        for end in range(1, num_tracks + 1):
+            if end == num_tracks or keys[end] != keys[start]:
+                candidates = tracks2[start:end]
+                for track in tracks1[start:end]:
+                    if track not in candidates:
+                        return False
+                start = end
         return True
 
     def print_tracks(self, verbose=False, max_measures=4):
@@ -75,10 +206,53 @@ class Song:
         self.tracks.append(track)
         return track
 
+    def release(self):
+        """Removes all measures from the song's tracks and releases them and their events for
+        reuse when building other songs. Call this when the song's contents are no longer
+        needed."""
+        for track in self.tracks:
+            for measure in track.measures:
+                measure.release()
+            track.measures.clear()
+
     def save(self, output_filename):
-        """Save this Song object to a zipped pickle file."""
-        with gzip.open(output_filename, 'wb') as f:
-            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        """Save this Song object to a compressed NumPy .npz file. The tracks, measures, events and
+        notes are each stored as one structured array, so saving and loading take a few bulk
+        writes rather than pickling every object. output_filename may also be a binary file
+        object. The song and track names must be str or None, and time_signature_changes a list
+        of (tick, numerator, denominator) tuples."""
+        tracks = self.tracks
+        names = [self.name] + [track.name for track in tracks]
+        for name in names:
+            _check_name(name)
+        time_signature_changes = _time_signature_changes_array(self.time_signature_changes)
+        measures = [measure for track in tracks for measure in track.measures]
+        events = [event for measure in measures for event in measure.events]
+
+        track_rows = np.array([(track.program, track.channel, int(track.track_type),
+                                len(track.measures)) for track in tracks], dtype=_TRACK_DTYPE)
+        measure_rows = np.array([(measure.start_tick, measure.time_signature.numerator,
+                                  measure.time_signature.denominator, len(measure.events))
+                                 for measure in measures], dtype=_MEASURE_DTYPE)
+        event_rows = np.array([(event.duration, len(event.pitches)) for event in events],
+                              dtype=_EVENT_DTYPE)
+        notes = np.concatenate([track.note_array() for track in tracks]
+                               or [np.empty(0, dtype=NOTE_DTYPE)])
+        notes = repack_fields(notes[['pitch', 'velocity', 'tie']])
+
+        song_row = np.array([self.ticks_per_beat, self.time_signature.numerator,
+                             self.time_signature.denominator, self.key.tonic_pitch_class,
+                             self.key.mode.value], dtype=np.int64)
+        arrays = dict(song=song_row, names=np.array([name or '' for name in names], dtype=str),
+                      unnamed=np.array([name is None for name in names], dtype=np.bool_),
+                      time_signature_changes=time_signature_changes, tracks=track_rows,
+                      measures=measure_rows, events=event_rows, notes=notes)
+        if hasattr(output_filename, 'write'):
+            np.savez_compressed(output_filename, **arrays)
+            return
+        # Pass a file object: given a path, numpy would append '.npz' to it.
+        with open(output_filename, 'wb') as f:
+            np.savez_compressed(f, **arrays)
 
     #def export_to_midi(self, output_filename):
     #    """Export this song to a MIDI file."""
@@ -91,9 +265,51 @@ class Song:
 
     @staticmethod
     def load(filename):
-        """Load a Song object from a Song zipped pickle file. Returns the Song object."""
-        with gzip.open(filename, 'rb') as f:
-            return pickle.load(f)
+        """Load a Song object from a file written by Song.save, or from a zipped pickle file
+        written by earlier versions. filename may also be a seekable binary file object. Returns
+        the Song object."""
+        if not _is_npz(filename):
+            with gzip.open(filename, 'rb') as f:
+                return _song_from_legacy(_LegacyUnpickler(f).load())
+
+        with np.load(filename, allow_pickle=False) as data:
+            names = [None if unnamed else name
+                     for name, unnamed in zip(data['names'].tolist(), data['unnamed'].tolist())]
+            ticks_per_beat, numerator, denominator, tonic_pitch_class, mode = data['song'].tolist()
+            time_signature_changes = data['time_signature_changes'].tolist()
+            track_rows = data['tracks'].tolist()
+            measure_rows = data['measures'].tolist()
+            events = data['events']
+            notes = data['notes']
+
+        song = Song(names[0], ticks_per_beat)
+        song.time_signature = TimeSignature(numerator, denominator)
+        song.key = Key(tonic_pitch_class, mode=Mode(mode))
+        song.time_signature_changes = [tuple(change) for change in time_signature_changes]
+
+        durations = events['duration'].tolist()
+        offsets = np.concatenate(([0], np.cumsum(events['num_notes']))).tolist()
+        pitches = notes['pitch'].tobytes()
+        velocities = notes['velocity'].tobytes()
+        ties = notes['tie'].tobytes()
+
+        measure_rows = iter(measure_rows)
+        event_idx = 0
+        for name, (program, channel, track_type, num_measures) in zip(names[1:], track_rows):
+            track = song.new_track(name, program, channel, TrackType(track_type))
+            for start_tick, numerator, denominator, num_events in islice(measure_rows,
+                                                                          num_measures):
+                measure = track.new_measure(TimeSignature(numerator, denominator))
+                measure.start_tick = start_tick
+                for i in range(event_idx, event_idx + num_events):
+                    event = measure.new_event(durations[i])
+                    start = offsets[i]
+                    end = offsets[i + 1]
+                    if start != end:
+                        event.extend_notes(pitches[start:end], velocities[start:end],
+                                           ties[start:end])
+                event_idx += num_events
+        return song
 
     def export_vector(self):
         raise NotImplementedError()
@@ -104,20 +320,28 @@ class Song:
     def adjust_ties_(self, clean_up, smooth_harmony):
         """Provides cleaning and smoothing options for ties."""
         for track in self:
-            if smooth_harmony and track.track_type != TrackType.HARMONY:
+            if smooth_harmony and track.track_type is not TrackType.HARMONY:
                 continue
-            prev_sounding_notes = set()
-            for measure in track:
-                for event in measure:
-                    sounding_notes = set()
-                    for note in event:
-                        if note.midi_pitch in prev_sounding_notes:
-                            if smooth_harmony:
-                                note.tie_from_previous = True
-                        elif clean_up:
-                            note.tie_from_previous = False
-                        sounding_notes.add(note.midi_pitch)
-                    prev_sounding_notes = sounding_notes
+            events = [event for measure in track for event in measure]
+            event_sizes = np.fromiter((len(event.pitches) for event in events), dtype=np.int64,
+                                      count=len(events))
+            if not event_sizes.any():
+                continue
+
+            pitches = np.frombuffer(b''.join(event.pitches.tobytes() for event in events),
+                                    dtype=np.int8)
+            was_sounding = _sounding_in_previous_event(pitches, event_sizes)
+
+            ties = np.frombuffer(b''.join(event.ties for event in events), dtype=np.bool_)
+            if smooth_harmony:
+                ties = ties | was_sounding
+            if clean_up:
+                ties = ties & was_sounding
+
+            ties = ties.tobytes()
+            offsets = np.concatenate(([0], np.cumsum(event_sizes))).tolist()
+            for event, start, end in zip(events, offsets, offsets[1:]):
+                event.set_ties(ties[start:end])
 
     def clean_ties(self):
         """Remove any tie_from_previous Note parameters where the note wasn't previously sounding."""
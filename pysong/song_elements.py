@@ -1,29 +1,57 @@
 """A collection of classes used to define a Song."""
 
-from copy import deepcopy
-from enum import Enum
+import sys
+from array import array
+from enum import Enum, IntEnum
 from functools import total_ordering
+from itertools import chain
+
+import numpy as np
 
 from pysong.exceptions import ArgumentError
 
 
 class TimeSignature:
-    """Represents a time signature."""
-    def __init__(self, numerator=4, denominator=4):
-        self.numerator = numerator
-        self.denominator = denominator
+    """Represents a time signature. TimeSignature objects are immutable, and equal TimeSignatures
+    are shared: constructing one returns an existing instance if an equal one has been made
+    before."""
+    __slots__ = ('numerator', 'denominator', '_repr')
+
+    # Shared instances, keyed by (numerator, denominator).
+    _POOL = {}
+
+    def __new__(cls, numerator=4, denominator=4):
+        ts = cls._POOL.get((numerator, denominator))
+        if ts is None:
+            ts = object.__new__(cls)
+            object.__setattr__(ts, 'numerator', numerator)
+            object.__setattr__(ts, 'denominator', denominator)
+            object.__setattr__(ts, '_repr', sys.intern('%d/%d' % (numerator, denominator)))
+            cls._POOL[(numerator, denominator)] = ts
+        return ts
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TimeSignature objects are immutable')
+
+    def __reduce__(self):
+        return (TimeSignature, (self.numerator, self.denominator))
 
     def __repr__(self):
-        return '%d/%d' % (self.numerator, self.denominator)
+        return self._repr
 
     def __eq__(self, ts2):
-        return (isinstance(ts2, TimeSignature)
-                and self.numerator == ts2.numerator
-                and self.denominator == ts2.denominator)
+        if self is ts2:
+            return True
+        if ts2.__class__ is not TimeSignature:
+            return NotImplemented
+        return self.numerator == ts2.numerator and self.denominator == ts2.denominator
 
     def __ne__(self, ts2):
         return not self == ts2
 
+    def __hash__(self):
+        return hash((self.numerator, self.denominator))
+
 
 class Mode(Enum):
     """Enum to represent Major/Minor mode."""
@@ -35,15 +63,25 @@ class Mode(Enum):
 _PC_TO_NAME_MAJOR = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
 _PC_TO_NAME_MINOR = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'Bb', 'B')
 
-# Lookup tables mapping from # sharps to pitch class and vice versa.
-_SHARPS_TO_TONIC_MAJOR = {i: (7 * i) % 12 for i in range(-6, 7)}
-_SHARPS_TO_TONIC_MINOR = {i: (7 * i - 3) % 12 for i in range(-6, 7)}
-_TONIC_TO_SHARPS_MAJOR = {_SHARPS_TO_TONIC_MAJOR[i]: i for i in range(-6, 7)}
-_TONIC_TO_SHARPS_MINOR = {_SHARPS_TO_TONIC_MINOR[i]: i for i in range(-6, 7)}
+# Lookup tables mapping from # sharps to pitch class and vice versa. The sharps-to-tonic tables are
+# indexed by num_sharps + 6; the tonic-to-sharps tables are indexed by pitch class, with F#/Gb
+# major (and D#/Eb minor) written with 6 sharps.
+_SHARPS_TO_TONIC_MAJOR = tuple((7 * i) % 12 for i in range(-6, 7))
+_SHARPS_TO_TONIC_MINOR = tuple((7 * i - 3) % 12 for i in range(-6, 7))
+_TONIC_TO_SHARPS_MAJOR = tuple(next(i for i in range(6, -7, -1) if (7 * i) % 12 == pc)
+                               for pc in range(12))
+_TONIC_TO_SHARPS_MINOR = tuple(next(i for i in range(6, -7, -1) if (7 * i - 3) % 12 == pc)
+                               for pc in range(12))
 
 class Key:
-    """Represents a musical key signature."""
-    def __init__(self, tonic_pitch_class=None, num_sharps=None, mode=Mode.MAJOR):
+    """Represents a musical key signature. Key objects are immutable, and equal Keys are shared
+    like TimeSignatures."""
+    __slots__ = ('mode', 'tonic_pitch_class', '_repr')
+
+    # Shared instances, keyed by (tonic_pitch_class, mode).
+    _POOL = {}
+
+    def __new__(cls, tonic_pitch_class=None, num_sharps=None, mode=Mode.MAJOR):
         """Must specify either tonic_pitch_class or num_sharps.
         tonic_pitch_class: 0-11. 0=C, 1=C#, etc.
         num_sharps: positive number for # sharps. Negative number represents # of flats.
@@ -54,40 +92,61 @@ class Key:
             raise ArgumentError('Specify exactly one of {tonic_pitch_class, num_sharps}')
 
         assert isinstance(mode, Mode)
-        self.mode = mode
 
         if tonic_pitch_class is not None:
             assert tonic_pitch_class >= 0 and tonic_pitch_class < 12
-            self.tonic_pitch_class = tonic_pitch_class
         else:
             assert num_sharps > -7 and num_sharps < 7
-            if mode == Mode.MAJOR:
-                self.tonic_pitch_class = _SHARPS_TO_TONIC_MAJOR[num_sharps]
+            if mode is Mode.MAJOR:
+                tonic_pitch_class = _SHARPS_TO_TONIC_MAJOR[num_sharps + 6]
             else:
-                self.tonic_pitch_class = _SHARPS_TO_TONIC_MINOR[num_sharps]
+                tonic_pitch_class = _SHARPS_TO_TONIC_MINOR[num_sharps + 6]
 
-    def __repr__(self):
-        if self.mode == Mode.MAJOR:
+        key = cls._POOL.get((tonic_pitch_class, mode))
+        if key is not None:
+            return key
+
+        key = object.__new__(cls)
+        object.__setattr__(key, 'mode', mode)
+        object.__setattr__(key, 'tonic_pitch_class', tonic_pitch_class)
+        if mode is Mode.MAJOR:
             name_map = _PC_TO_NAME_MAJOR
         else:
             name_map = _PC_TO_NAME_MINOR
-        return '%s %s' % (name_map[self.tonic_pitch_class], self.mode.name)
+        object.__setattr__(key, '_repr',
+                           sys.intern('%s %s' % (name_map[tonic_pitch_class], mode.name)))
+        cls._POOL[(tonic_pitch_class, mode)] = key
+        return key
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Key objects are immutable')
+
+    def __reduce__(self):
+        return (Key, (self.tonic_pitch_class, None, self.mode))
+
+    def __repr__(self):
+        return self._repr
 
     def __eq__(self, key2):
-        return (isinstance(key2, Key)
-                and self.tonic_pitch_class == key2.tonic_pitch_class
-                and self.mode == key2.mode)
+        if self is key2:
+            return True
+        if key2.__class__ is not Key:
+            return NotImplemented
+        return self.tonic_pitch_class == key2.tonic_pitch_class and self.mode is key2.mode
+
+    def __hash__(self):
+        return hash((self.tonic_pitch_class, self.mode))
 
     def number_of_sharps(self):
         """Returns the number of sharps in the key signature, or negative numbers for the number
         of flats, as in MIDI key signatures."""
-        if self.mode == Mode.MAJOR:
+        if self.mode is Mode.MAJOR:
             return _TONIC_TO_SHARPS_MAJOR[self.tonic_pitch_class]
         return _TONIC_TO_SHARPS_MINOR[self.tonic_pitch_class]
 
 
 
-class TrackType(Enum):
+class TrackType(IntEnum):
     """Enum to represent JukeDeck-style type of a track (Melody/Harmony/etc.)"""
     UNKNOWN = 0
     MELODY = 1
@@ -97,8 +156,19 @@ class TrackType(Enum):
     FX = 5
 
 
+# Row type of Track.note_array: one row per note, with its measure index, the start tick and
+# duration of its event, and the note itself.
+NOTE_DTYPE = np.dtype([('measure_idx', 'i4'), ('event_tick', 'i4'), ('duration', 'i4'),
+                       ('pitch', 'i1'), ('velocity', 'i1'), ('tie', '?')])
+
+# TrackType names indexed by value, to avoid going through the enum machinery for .name.
+_TRACK_TYPE_NAMES = tuple(track_type.name for track_type in TrackType)
+
+
 class Track:
     """Stores a single track (instrument) in a Song. Consists of multiple measures."""
+    __slots__ = ('name', 'program', 'channel', 'track_type', 'parent_song', 'measures')
+
     def __init__(self, name, program, channel, track_type, parent_song):
         self.name = name
         self.program = program  # MIDI program number
@@ -108,7 +178,8 @@ class Track:
         assert isinstance(track_type, TrackType)
         self.track_type = track_type
 
-        assert isinstance(parent_song, Core.song.Song)
+        # Duck-typed check: importing pysong.song here would be circular.
+        assert hasattr(parent_song, 'tracks')
         self.parent_song = parent_song
         self.measures = []
 
@@ -116,32 +187,100 @@ class Track:
         return iter(self.measures)
 
     def __eq__(self, t2):
-        if (not (isinstance(t2, Track) and self.name == t2.name and self.program == t2.program
-                 and self.channel == t2.channel and self.track_type == t2.track_type
-                 and len(self.measures) == len(t2.measures))):
+        if t2.__class__ is not Track:
+            return NotImplemented
+        measures1 = self.measures
+        measures2 = t2.measures
+        if (not (self.name == t2.name and self.program == t2.program
+                 and self.channel == t2.channel and self.track_type is t2.track_type
+                 and len(measures1) == len(measures2))):
             return False
-        for i, measure in enumerate(self.measures):
-            if not measure == t2.measures[i]:
+        for measure1, measure2 in zip(measures1, measures2):
+            if not measure1 == measure2:
                 return False
         return True
 
     def __repr__(self):
         return '%s (program:%d, channel=%d, type=%s)' % (self.name, self.program, self.channel,
-                                                         self.track_type.name)
+                                                         _TRACK_TYPE_NAMES[self.track_type])
+
+    def _end_tick(self):
+        """Returns the tick at which the last measure ends, which is where a new measure starts."""
+        if not self.measures:
+            return 0
+        prev_measure = self.measures[-1]
+        return prev_measure.start_tick + prev_measure.get_duration_ticks()
 
     def new_measure(self, time_signature=None):
         """Adds a new measure at the end of the track and returns the measure."""
-        next_tick = 0
-        if self.measures:
-            prev_measure = self.measures[-1]
-            next_tick = prev_measure.start_tick + prev_measure.get_duration_ticks()
-        measure = Measure(next_tick, self, time_signature)
+        measure = Measure._new(self._end_tick(), self, time_signature)
         self.measures.append(measure)
         return measure
 
+    def new_measures(self, time_signatures):
+        """Adds one new measure per time signature at the end of the track and returns the list of
+        new measures. A time signature of None uses the song's, as in new_measure. The measures
+        list is extended once rather than appended to per measure."""
+        measures = [None] * len(time_signatures)
+        next_tick = self._end_tick()
+        for i, time_signature in enumerate(time_signatures):
+            measure = Measure._new(next_tick, self, time_signature)
+            next_tick += measure.get_duration_ticks()
+            measures[i] = measure
+        self.measures += measures
+        return measures
+
+    def note_array(self):
+        """Returns all notes of the track as a NumPy structured array with dtype NOTE_DTYPE, in
+        track order. Built from the events in one pass, so that bulk operations on the notes don't
+        need to go through the Event and Note objects."""
+        measure_indices = []
+        event_ticks = []
+        durations = []
+        counts = []
+        events = []
+        for measure_idx, measure in enumerate(self.measures):
+            tick = measure.start_tick
+            for event in measure.events:
+                if event._pitches:
+                    measure_indices.append(measure_idx)
+                    event_ticks.append(tick)
+                    durations.append(event._duration)
+                    counts.append(len(event._pitches))
+                    events.append(event)
+                tick += event._duration
+
+        notes = np.empty(sum(counts), dtype=NOTE_DTYPE)
+        notes['measure_idx'] = np.repeat(measure_indices, counts)
+        notes['event_tick'] = np.repeat(event_ticks, counts)
+        notes['duration'] = np.repeat(durations, counts)
+        notes['pitch'] = np.frombuffer(b''.join(event._pitches.tobytes() for event in events),
+                                       dtype=np.int8)
+        notes['velocity'] = np.frombuffer(
+            b''.join(event._velocities.tobytes() for event in events), dtype=np.int8)
+        notes['tie'] = np.frombuffer(b''.join(event._ties for event in events), dtype=np.bool_)
+        return notes
+
+
+# Maximum number of released Measure and Event objects kept for reuse (per class).
+_FREE_LIST_SIZE = 100000
+
+
+def _effective_len(events):
+    """Returns the number of events in the list, not counting any rests at the end."""
+    length = len(events)
+    while length > 0 and not events[length - 1]._pitches:
+        length -= 1
+    return length
+
 
 class Measure:
     """Stores a single measure of a single track. Consists of multiple Events."""
+    __slots__ = ('events', 'start_tick', 'parent_track', 'time_signature')
+
+    # Released measures, reused by Track.new_measure.
+    _FREE = []
+
     def __init__(self, start_tick, parent_track, time_signature=None):
         assert isinstance(parent_track, Track)
         self.events = []
@@ -157,33 +296,18 @@ class Measure:
         return iter(self.events)
 
     def __eq__(self, m2):
-        if not (isinstance(m2, Measure)):
-            return False
+        if m2.__class__ is not Measure:
+            return NotImplemented
 
         # Ignore any final rests in a measure in comparison.
-        events1 = deepcopy(self.events)
-        events2 = deepcopy(m2.events)
-        len_events1 = len(events1)
-        for i in range(len(events1) - 1, -1, -1):
-            if not events1[i].notes:
-                len_events1 = i
-            else:
-                # As soon as we see notes, break.
-                break
-
-        len_events2 = len(events2)
-        for i in range(len(events2) - 1, -1, -1):
-            if not events2[i].notes:
-                len_events2 = i
-            else:
-                # As soon as we see notes, break.
-                break
-
-        if len_events1 != len_events2:
+        events1 = self.events
+        events2 = m2.events
+        len_events = _effective_len(events1)
+        if len_events != _effective_len(events2):
             return False
 
-        for i in range(0, len_events1):
-            if not self.events[i] == m2.events[i]:
+        for i in range(0, len_events):
+            if not events1[i] == events2[i]:
                 return False
         return True
 
@@ -193,56 +317,181 @@ class Measure:
             s += '\n\t%s' % str(event)
         return s
 
+    @classmethod
+    def _new(cls, start_tick, parent_track, time_signature=None):
+        """Returns a measure from the free list if there is one, otherwise a new measure."""
+        if cls._FREE:
+            measure = cls._FREE.pop()
+            measure.__init__(start_tick, parent_track, time_signature)
+            return measure
+        return cls(start_tick, parent_track, time_signature)
+
+    def release(self):
+        """Releases this measure and all of its events for reuse by later new_measure/new_event
+        calls. The measure and its events must not be used afterwards."""
+        if self.events is None:
+            return  # Already released.
+        for event in self.events:
+            event.release()
+        self.events = None
+        self.parent_track = None
+        self.time_signature = None
+        if len(Measure._FREE) < _FREE_LIST_SIZE:
+            Measure._FREE.append(self)
+
     def new_event(self, duration):
-        event = Event(duration)
+        event = Event._new(duration)
         self.events.append(event)
         return event
 
     def get_duration_ticks(self):
         """Returns the length of the measure in ticks, based on the time signature."""
-        beats = self.time_signature.numerator * 4.0 / self.time_signature.denominator
-        return int(beats * self.parent_track.parent_song.ticks_per_beat)
+        time_signature = self.time_signature
+        return (time_signature.numerator * 4 * self.parent_track.parent_song.ticks_per_beat
+                // time_signature.denominator)
 
 
 class Event:
     """Stores a single Event in a single track. This consists of all notes sounding at a particular
-    moment in time, and a duration."""
+    moment in time, and a duration.
+
+    Notes are stored as parallel arrays of pitches, velocities and tie_from_previous flags rather
+    than as Note objects. Note objects are built on demand when iterating over the event."""
+    __slots__ = ('_pitches', '_velocities', '_ties', '_duration', '_canonical', '_tied_pitches')
+
+    # Released events, reused by Measure.new_event.
+    _FREE = []
+
     def __init__(self, duration=0):
-        self.notes = []
-        self.duration = int(duration)  # in ticks (as defined in the ancestor Song object)
+        self._pitches = array('b')
+        self._velocities = array('b')
+        self._ties = bytearray()
+        self._canonical = None  # cached canonical(); reset whenever the event changes
+        self._tied_pitches = None  # cached tied_pitches; reset whenever the notes change
+        self.duration = duration
 
     def __iter__(self):
-        return iter(self.notes)
+        return map(Note, self._pitches, self._velocities, map(bool, self._ties))
 
     def __eq__(self, e2):
-        if not (isinstance(e2, Event) and self.duration == e2.duration
-                and len(self.notes) == len(e2.notes)):
+        if e2.__class__ is not Event:
+            return NotImplemented
+        pitches1 = self._pitches
+        pitches2 = e2._pitches
+        if not (self._duration == e2._duration and len(pitches1) == len(pitches2)):
             return False
 
-        # Don't require notes to be in same order. Treat as a set.
-        for note in self.notes:
-            for note2 in e2.notes:
-                if note == note2:
-                    break
-            else:
-                return False
-        return True
+        # Don't require notes to be in same order. Events built the same way list their notes in
+        # the same order, so first compare the arrays as they are. Otherwise compare the
+        # canonical forms, which list the notes sorted and are cached.
+        return ((pitches1 == pitches2 and self._velocities == e2._velocities
+                 and self._ties == e2._ties)
+                or self.canonical() == e2.canonical())
 
     def __repr__(self):
-        s = 'Event duration: %d [' % self.duration
-        for i, note in enumerate(self.notes):
-            s += str(note)
-            if i < len(self.notes) - 1:
-                s += ', '
-        s += ']'
-        return s
+        return 'Event duration: %d [%s]' % (self.duration, ', '.join(str(note) for note in self))
+
+    @classmethod
+    def _new(cls, duration):
+        """Returns an empty event from the free list if there is one, otherwise a new event."""
+        if cls._FREE:
+            event = cls._FREE.pop()
+            event.duration = duration
+            return event
+        return cls(duration)
+
+    def release(self):
+        """Clears this event and keeps it for reuse by a later Measure.new_event call. The event
+        must not be used afterwards."""
+        if self._duration is None:
+            return  # Already released.
+        del self._pitches[:]
+        del self._velocities[:]
+        del self._ties[:]
+        self._duration = None
+        self._canonical = None
+        self._tied_pitches = None
+        if len(Event._FREE) < _FREE_LIST_SIZE:
+            Event._FREE.append(self)
+
+    @property
+    def duration(self):
+        """Duration in ticks (as defined in the ancestor Song object)."""
+        return self._duration
+
+    @duration.setter
+    def duration(self, duration):
+        self._duration = int(duration)
+        self._canonical = None
+
+    @property
+    def notes(self):
+        """A new list of the Notes in this event."""
+        return list(self)
+
+    @property
+    def pitches(self):
+        """MIDI pitches of the notes in this event, as a read-only memoryview of int8 values. Use
+        append_note/extend_notes to change the notes, and don't hold on to the view while doing
+        so."""
+        return memoryview(self._pitches).toreadonly()
+
+    @property
+    def velocities(self):
+        """Velocities of the notes in this event, as a read-only memoryview of int8 values."""
+        return memoryview(self._velocities).toreadonly()
+
+    @property
+    def ties(self):
+        """tie_from_previous flags of the notes in this event, as a read-only memoryview of 0/1
+        bytes. Use set_ties() to change them."""
+        return memoryview(self._ties).toreadonly()
+
+    @property
+    def tied_pitches(self):
+        """frozenset of the MIDI pitches of the tie_from_previous notes in this event. Cached until
+        the notes change."""
+        if self._tied_pitches is None:
+            self._tied_pitches = frozenset(
+                pitch for pitch, tie in zip(self._pitches, self._ties) if tie)
+        return self._tied_pitches
+
+    def set_ties(self, ties):
+        """Replaces the tie_from_previous flags of all notes. ties: one 0/1 value per note."""
+        assert len(ties) == len(self._ties)
+        self._ties[:] = ties
+        self._canonical = None
+        self._tied_pitches = None
+
+    def canonical(self):
+        """Returns a bytes encoding of the duration and notes, independent of note order. Two
+        events are equal exactly when their canonical forms are equal. Cached until the event is
+        modified."""
+        if self._canonical is None:
+            rows = sorted(zip(self._pitches, self._velocities, self._ties))
+            self._canonical = (self._duration.to_bytes(8, 'little', signed=True)
+                               + array('b', chain.from_iterable(rows)).tobytes())
+        return self._canonical
 
     def append_note(self, note):
-        self.notes.append(note)
+        self._pitches.append(note.midi_pitch)
+        self._velocities.append(note.velocity)
+        self._ties.append(bool(note.tie_from_previous))
+        self._canonical = None
+        self._tied_pitches = None
+
+    def extend_notes(self, pitches, velocities, ties):
+        """Appends notes given as three bytes-like objects of equal length: the int8 MIDI pitches,
+        the int8 velocities and the 0/1 tie_from_previous flags."""
+        self._pitches.frombytes(pitches)
+        self._velocities.frombytes(velocities)
+        self._ties += ties
+        self._canonical = None
+        self._tied_pitches = None
 
     def new_note(self, midi_pitch, velocity=-1, tie_from_previous=False):
         note = Note(midi_pitch, velocity, tie_from_previous)
-        self.notes.append(note)
+        self.append_note(note)
         return note
 
 
@@ -250,19 +499,44 @@ class Event:
 class Note:
     """Stores a single Note. This is either a note on event or a continuation of a previously
     sounding note. Note off events are handled implicitly by the presence of a later event where
-    the note is not sounding."""
-    def __init__(self, midi_pitch, velocity=-1, tie_from_previous=False):
-        self.midi_pitch = midi_pitch
-        self.velocity = velocity  # set to -1 if tie_from_previous==True
-        self.tie_from_previous = tie_from_previous
+    the note is not sounding.
+
+    Notes are immutable, and equal Notes are shared: constructing a Note returns an existing
+    instance if one with the same pitch, velocity and tie flag has been made before."""
+    __slots__ = ('midi_pitch', 'velocity', 'tie_from_previous')
+
+    # Shared instances, keyed by (midi_pitch, velocity, tie_from_previous).
+    _POOL = {}
+
+    def __new__(cls, midi_pitch, velocity=-1, tie_from_previous=False):
+        key = (midi_pitch, velocity, bool(tie_from_previous))
+        note = cls._POOL.get(key)
+        if note is None:
+            note = object.__new__(cls)
+            object.__setattr__(note, 'midi_pitch', midi_pitch)
+            object.__setattr__(note, 'velocity', velocity)  # set to -1 if tie_from_previous==True
+            object.__setattr__(note, 'tie_from_previous', key[2])
+            cls._POOL[key] = note
+        return note
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Note objects are immutable')
+
+    def __reduce__(self):
+        return (Note, (self.midi_pitch, self.velocity, self.tie_from_previous))
 
     def __eq__(self, n2):
-        return (isinstance(n2, Note) and self.midi_pitch == n2.midi_pitch
-                and self.velocity == n2.velocity
+        if n2.__class__ is not Note:
+            return NotImplemented
+        return (self.midi_pitch == n2.midi_pitch and self.velocity == n2.velocity
                 and self.tie_from_previous == n2.tie_from_previous)
 
+    def __hash__(self):
+        return hash((self.midi_pitch, self.velocity, self.tie_from_previous))
+
     def __lt__(self, n2):
-        assert isinstance(n2, Note)
+        if n2.__class__ is not Note:
+            return NotImplemented
         return self.midi_pitch < n2.midi_pitch
 
     def __repr__(self):
@@ -2,23 +2,68 @@
 
 TODO: implement time signature export to MIDI. Currently there are no time signature change
       messages in the output MIDI file.
-
-TODO: refactor to simplify computation of "delta" values in midi export.
 """
 
-from collections import defaultdict
+import io
+import struct
 from enum import IntEnum
+from itertools import chain
 
+import numpy as np
 from mido import Message, MetaMessage, MidiFile, MidiTrack
-from pretty_midi import PrettyMIDI, Instrument
 
-from pysong.pretty_midi_utils import get_all_time_signatures
 from pysong.song import Song
-from pysong.song_elements import TrackType, Note, Event, Measure
+from pysong.song_elements import TrackType, TimeSignature, Note, Event, Measure
 
 
 _DRUM_CHANNEL = 9
 
+# A rest appended to the events of each measure in export_midi. If the measure's events end before
+# the measure does, it turns off all notes that are still sounding. Never modified.
+_MEASURE_END = Event()
+
+# The tie_from_previous Note for each MIDI pitch, so that tied notes don't need a Note lookup.
+_TIE_NOTES = tuple(Note(pitch, tie_from_previous=True) for pitch in range(128))
+
+# Number of data bytes of each system message that mido reads from MIDI files.
+_SYSTEM_MESSAGE_SIZES = {0xf1: 1, 0xf2: 2, 0xf3: 1, 0xf6: 0, 0xf8: 0, 0xfa: 0, 0xfb: 0, 0xfc: 0,
+                         0xfe: 0}
+
+# mido refuses to read longer messages.
+_MAX_MESSAGE_LENGTH = 1000000
+
+# Meta message types used by the importer, by mido message type.
+_META_TYPES = {'text': 0x01, 'track_name': 0x03, 'lyrics': 0x05, 'set_tempo': 0x51,
+               'time_signature': 0x58, 'key_signature': 0x59}
+_META_TYPE_BYTES = frozenset(_META_TYPES.values())
+
+# PrettyMIDI refuses to load files with events at or after this tick.
+_MAX_TICK = 10000000
+
+
+def _tick_dtype(max_tick):
+    """Returns the dtype for arrays of ticks up to max_tick: int32, which is enough for any
+    realistic song and halves the memory of int64, or int64 for longer songs."""
+    return np.int32 if max_tick <= np.iinfo(np.int32).max else np.int64
+
+
+def _is_valid_meta_message(meta_type, data):
+    """Returns False for the meta messages with the given type and data bytes that mido fails to
+    decode."""
+    if meta_type == 0x00:  # sequence number
+        return len(data) != 1
+    if meta_type == 0x20:  # channel prefix
+        return len(data) >= 1
+    if meta_type == 0x51:  # tempo
+        return len(data) >= 3
+    if meta_type == 0x54:  # SMPTE offset
+        return len(data) >= 5 and data[0] >> 5 <= 3
+    if meta_type == 0x58:  # time signature
+        return len(data) >= 4
+    if meta_type == 0x59:  # key signature
+        return len(data) >= 2 and (data[0] <= 7 or data[0] >= 256 - 7) and data[1] <= 1
+    return True
+
 
 class _EventType(IntEnum):
     """This ordering is intentional, as it is used to sort events in get_events below."""
@@ -27,24 +72,50 @@ class _EventType(IntEnum):
     NOTE_ON = 3
 
 
+def _note_message(message_type, channel, note, velocity, time):
+    """Returns Message(message_type, channel=channel, note=note, velocity=velocity, time=time) for
+    a note_on or note_off message. Fills in the message attributes directly, which is several
+    times faster than the Message constructor since mido's argument checks are skipped. The
+    caller is responsible for passing valid values. Relies on mido storing the attributes in the
+    instance __dict__, as the mido 1.3 releases that pysong requires do."""
+    message = Message.__new__(Message)
+    vars(message).update(type=message_type, time=time, channel=channel, note=note,
+                         velocity=velocity)
+    return message
+
+
 class SongMidiConverter():
     """Class providing Song to/from MIDI conversion routines."""
 
     @staticmethod
-    def _turn_off_notes(midi_track, channel, tick, prev_tick, notes_to_turn_off,  # pylint: disable=dangerous-default-value
-                        notes_to_ignore=[]):
-        """Create add MIDI messages to turn off all given notes except those in the ignore list."""
-        for pitch in notes_to_turn_off:
-            if pitch not in notes_to_ignore:
-                delta = tick - prev_tick
-                prev_tick = tick
-                midi_track.append(Message('note_off', channel=channel, note=pitch,
-                                          velocity=0, time=delta))
-        return prev_tick
+    def _turn_off_notes(midi_events, tick, notes_to_turn_off, notes_to_ignore=frozenset()):
+        """Add note-off events at the given tick for all given notes except those to ignore. Both
+        are sets of MIDI pitches."""
+        midi_events.extend((tick, 'note_off', pitch, 0)
+                           for pitch in notes_to_turn_off - notes_to_ignore)
+
+    @staticmethod
+    def _make_messages(midi_events, channel):
+        """Convert a list of (absolute tick, message type, data1, data2) tuples into MIDI messages
+        with delta times. data1 and data2 are the note and velocity of note messages, and the
+        numerator and denominator of time signature messages."""
+        # The events are in tick order, so the last one has the largest tick.
+        max_tick = midi_events[-1][0] if midi_events else 0
+        ticks = np.fromiter((midi_event[0] for midi_event in midi_events),
+                            dtype=_tick_dtype(max_tick), count=len(midi_events))
+        deltas = np.diff(ticks, prepend=0)
+        if len(deltas) and deltas.min() < 0:
+            raise ValueError('MIDI events out of order; measure start ticks must not decrease')
+        deltas = deltas.tolist()
+        return [MetaMessage(kind, numerator=data1, denominator=data2, time=delta)
+                if kind == 'time_signature' else
+                _note_message(kind, channel, data1, data2, delta)
+                for (_, kind, data1, data2), delta in zip(midi_events, deltas)]
 
     @staticmethod
     def export_midi(song, file_name):
-        """Creates a midi file representing the current song and saves the result to a file."""
+        """Creates a midi file representing the current song and saves the result to a file.
+        file_name may also be a binary file object, such as an io.BytesIO."""
         midi_file = MidiFile(ticks_per_beat=song.ticks_per_beat)
 
         # TODO: Output key signature changes to track 0.
@@ -58,59 +129,59 @@ class SongMidiConverter():
                 print('Warning: too many channels for song %s. Skipping extra channel #%d.'
                       % (song.name, channel))
                 continue
-            midi_track.append(Message('program_change', channel=channel, program=track.program,
-                                      time=0))
+            program_change = Message('program_change', channel=channel, program=track.program,
+                                     time=0)
+            # Events are collected with absolute ticks; delta times are computed at the end.
+            midi_events = []
             measure_number = 0
-            prev_tick = 0
             tick = 0
             prev_sounding_notes = set()  # contains MIDI numbers of previously-sounding notes
             previous_time_signature = None
 
             for measure in track:
-                tick = measure.start_tick  # Jump to the start of this measure.
+                m_start = measure.start_tick
+                m_end = m_start + measure.get_duration_ticks()
+                time_signature = measure.time_signature
+                tick = m_start  # Jump to the start of this measure.
 
                 # Write a time signature message if it has changed.
                 # Only do this for track 0.
-                if track_idx == 0 and measure.time_signature != previous_time_signature:
-                    previous_time_signature = measure.time_signature
-                    delta = tick - prev_tick
-                    prev_tick = tick
-                    midi_track.append(MetaMessage(
-                        'time_signature',
-                        numerator=measure.time_signature.numerator,
-                        denominator=measure.time_signature.denominator,
-                        time=delta))
-
-                for event in measure:
+                if track_idx == 0 and time_signature != previous_time_signature:
+                    previous_time_signature = time_signature
+                    midi_events.append((tick, 'time_signature', time_signature.numerator,
+                                        time_signature.denominator))
+
+                for event in chain(measure, (_MEASURE_END,)):
+                    if event is _MEASURE_END and tick >= m_end:
+                        # The events fill the measure, so notes may be tied into the next one.
+                        break
+
                     sounding_notes = set()  # Notes that are sounding at this moment.
 
                     # First send a note off for all previously-sounding notes EXCEPT those
                     # which show up in the current event with the "tie_from_previous" flag set.
-                    tied_from_previous = set(n.midi_pitch for n in event if n.tie_from_previous)
-                    prev_tick = SongMidiConverter._turn_off_notes(midi_track, channel, tick,
-                                                                  prev_tick, prev_sounding_notes,
-                                                                  tied_from_previous)
-
-                    for note in event:
-                        pitch = note.midi_pitch
-                        velocity = note.velocity
-                        tie_from_previous = note.tie_from_previous
-                        assert pitch >= 0 and pitch < 128
-                        assert tie_from_previous or (velocity >= 0 and velocity < 128)
+                    SongMidiConverter._turn_off_notes(midi_events, tick, prev_sounding_notes,
+                                                      event.tied_pitches)
+
+                    # Read the note arrays directly rather than building Note objects.
+                    for pitch, velocity, tie_from_previous in zip(event.pitches, event.velocities,
+                                                                  event.ties):
+                        # Checked here since _note_message skips mido's own checks. The note
+                        # arrays are int8, so the values can't be 128 or more.
+                        if pitch < 0:
+                            raise ValueError('MIDI pitch %d out of range in track %s'
+                                             % (pitch, track.name))
+                        if velocity < 0 and not tie_from_previous:
+                            raise ValueError('velocity %d out of range in track %s'
+                                             % (velocity, track.name))
 
                         if velocity > 0 and not tie_from_previous:
                             # Handle note-on events.
-                            delta = tick - prev_tick
-                            prev_tick = tick
-                            midi_track.append(Message('note_on', channel=channel, note=pitch,
-                                                      velocity=note.velocity, time=delta))
+                            midi_events.append((tick, 'note_on', pitch, velocity))
                             sounding_notes.add(pitch)
                         elif not tie_from_previous:
                             # Handle explicit note-off events (note with velocity 0)
-                            delta = tick - prev_tick
-                            prev_tick = tick
-                            midi_track.append(Message('note_off', channel=channel, note=pitch,
-                                                      velocity=0, time=delta))
+                            midi_events.append((tick, 'note_off', pitch, 0))
                         else:
                             # Handle tie_from_previous.
                             sounding_notes.add(pitch)
@@ -118,33 +189,73 @@ class SongMidiConverter():
                     prev_sounding_notes = sounding_notes
                     tick += event.duration
 
-                # We processed all events in the measure.  If not at the end of the measure yet,
-                # turn off all notes.
-                if tick < measure.start_tick + measure.get_duration_ticks():
-                    prev_tick = SongMidiConverter._turn_off_notes(midi_track, channel, tick,
-                                                                  prev_tick, prev_sounding_notes)
-                    prev_sounding_notes = set()
-
                 measure_number += 1
 
             # Turn off all notes at end of track.
-            SongMidiConverter._turn_off_notes(midi_track, channel, tick, prev_tick,
-                                              prev_sounding_notes)
+            SongMidiConverter._turn_off_notes(midi_events, tick, prev_sounding_notes)
 
-            # End of track message.
-            midi_track.append(MetaMessage('end_of_track'))
+            # Add all messages of the track in one call, ending with the end of track message.
+            midi_track.extend([program_change,
+                               *SongMidiConverter._make_messages(midi_events, channel),
+                               MetaMessage('end_of_track')])
 
-        midi_file.save(file_name)
+        if hasattr(file_name, 'write'):
+            midi_file.save(file=file_name)
+            return
+
+        # Serialize in memory and write the file in one call; mido makes many small writes.
+        buffer = io.BytesIO()
+        midi_file.save(file=buffer)
+        with open(file_name, 'wb') as f:
+            f.write(buffer.getbuffer())
 
     @staticmethod
     def create_song_from_midi(file_name):
         """This method creates a new Song object by reading a MIDI file, and parsing the tracks,
         and converting them to song.Track objects. Also sets other Song metadata that can be
-        derived from the MIDI."""
+        derived from the MIDI. file_name may also be a binary file object, such as an
+        io.BytesIO."""
+        if hasattr(file_name, 'read'):
+            data = file_name.read()
+        else:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+        return SongMidiConverter._create_song(SongMidiConverter._read_midi_file(data),
+                                              lambda: data)
 
-        # Load MIDI file into PrettyMIDI object
+    @staticmethod
+    def create_song_from_mido(midi_file):
+        """Like create_song_from_midi, but for a mido MidiFile object. Reads the messages directly
+        instead of saving and parsing the file."""
+        def read_data():
+            buffer = io.BytesIO()
+            midi_file.save(file=buffer)
+            return buffer.getvalue()
+
+        return SongMidiConverter._create_song(SongMidiConverter._read_mido_file(midi_file),
+                                              read_data)
+
+    @staticmethod
+    def _create_song(midi_file, read_data):
+        """Creates a Song from the tracks of a MIDI file as returned by _read_midi_file. Loads the
+        file with PrettyMIDI instead if midi_file is None, or if the measures can't be derived
+        from the tracks (see _parse_midi_tracks). read_data is a function that returns the bytes
+        of the file for PrettyMIDI."""
+        if midi_file is not None:
+            ticks_per_beat, tracks = midi_file
+            if not tracks:
+                print("Error loading MIDI file. Ensure the file has at least 1 track.")
+                return Song()
+            parsed = SongMidiConverter._parse_midi_tracks(ticks_per_beat, tracks)
+            if parsed is not None:
+                instruments, downbeat_ticks, time_signatures = parsed
+                return SongMidiConverter._build_song('', ticks_per_beat, instruments,
+                                                     downbeat_ticks, time_signatures)
+
+        # pretty_midi is slow to import and most files never need it, so only import it here.
+        from pretty_midi import PrettyMIDI
         try:
-            midi = PrettyMIDI(file_name)
+            midi = PrettyMIDI(io.BytesIO(read_data()))
         except IndexError as e:
             print("Exception: %s" % e)
             print("Error loading MIDI file in PrettyMIDI. Ensure the file has at least 1 track.")
@@ -161,51 +272,556 @@ class SongMidiConverter():
                                                                           instrument_and_type_list)
 
     @staticmethod
-    def _get_measure_number(time, downbeats):
-        for i, downbeat in enumerate(downbeats):
-            if time >= downbeat:
-                return i - 1
-        # Not found.
-        raise Exception('measure number not found for time %f\nDownbeats: %s' % (time, downbeats))
+    def _read_mido_file(midi_file):
+        """Returns the tracks of a mido MidiFile in the same format as _read_midi_file, or None if
+        the file uses SMPTE time."""
+        if midi_file.ticks_per_beat <= 0:
+            return None
+        tracks = []
+        for track in midi_file.tracks:
+            channel_events = []
+            meta_events = []
+            tick = 0
+            for msg in track:
+                tick += msg.time
+                if msg.is_meta:
+                    meta_type = _META_TYPES.get(msg.type)
+                    if meta_type == 0x03:
+                        value = msg.name
+                    elif meta_type == 0x51:
+                        value = msg.tempo
+                    elif meta_type == 0x58:
+                        value = (msg.numerator, msg.denominator)
+                    else:
+                        value = None
+                    if meta_type is not None:
+                        meta_events.append((len(channel_events), tick, meta_type, value))
+                    continue
+                data = msg.bytes()
+                if data[0] < 0xf0:
+                    channel_events.append((tick, data[0], data[1],
+                                           data[2] if len(data) > 2 else 0))
+            tracks.append((channel_events, meta_events, tick))
+        return midi_file.ticks_per_beat, tracks
+
+    @staticmethod
+    def _read_variable_int(data, pos, end):
+        """Reads a variable length quantity from data[pos:end]. Returns a tuple (value, pos) with
+        the position after it, or None if it runs past end."""
+        value = 0
+        while pos < end:
+            byte = data[pos]
+            pos += 1
+            value = (value << 7) | (byte & 0x7f)
+            if byte < 0x80:
+                return value, pos
+        return None
 
     @staticmethod
-    def _get_events(instrument, downbeats, midi):
-        """Return a sorted list of tuples of (tick, _EventType, note). note is optional.
-        Notes here are pretty_mid notes, not Song notes."""
-        event_list = []
-        #note_starts = defaultdict(list)  # key is start tick, key is Note
-        #note_ends = defaultdict(list)  # key is end tick, key is Note
-        for note in instrument.notes:
-            start_tick = midi.time_to_tick(note.start)
-            end_tick = midi.time_to_tick(note.end)
-            event_list.append((start_tick, _EventType.NOTE_ON, note))
-            event_list.append((end_tick, _EventType.NOTE_OFF, note))
-        for downbeat in downbeats:
-            tick = midi.time_to_tick(downbeat)
-            event_list.append((tick, _EventType.MEASURE_START, None))
-
-        # Sort the list first by tick and second by event type. Thus, for events at the same tick,
-        # NOTE_OFF events are listed first, then MEASURE_START, and finally NOTE_ON.
-
-        def get_key(event):
-            if event[2] is not None:
-                return (event[0], event[1], event[2].pitch)
-            return (event[0], event[1])
-
-        return sorted(event_list, key=get_key)
+    def _read_midi_file(data):
+        """Splits the bytes of a standard MIDI file into tracks of events, without creating mido
+        messages, which is much faster than reading the file with mido.
+
+        returns: a tuple (ticks_per_beat, tracks). Each track is a tuple (channel_events,
+                 meta_events, last_tick), with absolute ticks:
+                   channel_events: a list of (tick, status, data1, data2) tuples. data2 is 0 for
+                                   messages with one data byte.
+                   meta_events: a list of (index, tick, meta_type, value) tuples for the meta
+                                messages in _META_TYPES, where index is the number of channel
+                                events before the meta event. value is the name of track name
+                                messages, the tempo of tempo messages, and (numerator,
+                                denominator) for time signature messages.
+                   last_tick: the tick of the last event in the track, including sysex and
+                              system messages, which are not listed.
+                 Returns None if the file uses SMPTE time, or if mido can't read it.
+        """
+        read_variable_int = SongMidiConverter._read_variable_int
+
+        if data[:4] != b'MThd' or len(data) < 8:
+            return None
+        header_size = int.from_bytes(data[4:8], 'big')
+        if header_size < 6 or len(data) < 8 + header_size:
+            return None
+        _, num_tracks, ticks_per_beat = struct.unpack_from('>hhh', data, 8)
+        if ticks_per_beat <= 0:
+            return None
+
+        pos = 8 + header_size
+        tracks = []
+        for _ in range(num_tracks):
+            if data[pos:pos + 4] != b'MTrk' or len(data) < pos + 8:
+                return None
+            end = pos + 8 + int.from_bytes(data[pos + 4:pos + 8], 'big')
+            pos += 8
+            if end > len(data):
+                return None
+
+            channel_events = []
+            meta_events = []
+            tick = 0
+            last_status = None
+            while pos < end:
+                delta = read_variable_int(data, pos, end)
+                if delta is None or delta[1] == end:
+                    return None
+                tick += delta[0]
+                pos = delta[1]
+                status = data[pos]
+                if status < 0x80:
+                    # Running status: the byte is the first data byte of the message.
+                    if last_status is None or last_status >= 0xf0:
+                        return None
+                    status = last_status
+                else:
+                    pos += 1
+                    if status != 0xff:
+                        last_status = status
+
+                if status < 0xf0:
+                    size = 1 if status & 0xe0 == 0xc0 else 2  # program change, channel pressure
+                    message = data[pos:pos + size]
+                    pos += size
+                    if pos > end or max(message) > 127:
+                        return None
+                    channel_events.append((tick, status, message[0],
+                                           message[-1] if size == 2 else 0))
+                    continue
+
+                if status == 0xff:
+                    if pos == end:
+                        return None
+                    meta_type = data[pos]
+                    length = read_variable_int(data, pos + 1, end)
+                    if length is None:
+                        return None
+                    length, pos = length
+                    payload = data[pos:pos + length]
+                    if not _is_valid_meta_message(meta_type, payload):
+                        return None
+                    if meta_type == 0x03:  # track name
+                        value = payload.decode('latin1')
+                    elif meta_type == 0x51:  # tempo
+                        value = int.from_bytes(payload[:3], 'big')
+                    elif meta_type == 0x58:  # time signature
+                        value = (payload[0], 2 ** payload[1])
+                    else:
+                        value = None
+                    if meta_type in _META_TYPE_BYTES:
+                        meta_events.append((len(channel_events), tick, meta_type, value))
+                elif status in (0xf0, 0xf7):
+                    length = read_variable_int(data, pos, end)
+                    if length is None:
+                        return None
+                    length, pos = length
+                elif status in _SYSTEM_MESSAGE_SIZES:
+                    length = _SYSTEM_MESSAGE_SIZES[status]
+                    if any(byte > 127 for byte in data[pos:pos + length]):
+                        return None
+                else:
+                    return None  # Undefined status byte.
+                pos += length
+                if pos > end or length > _MAX_MESSAGE_LENGTH:
+                    return None
+            tracks.append((channel_events, meta_events, tick))
+        return ticks_per_beat, tracks
 
     @staticmethod
-    def _write_event(delta_duration, current_measure, notes_to_add, sounding_notes):
-        event = current_measure.new_event(delta_duration)
-        pitches_written = defaultdict(bool)
-        for note in notes_to_add:
-            event.append_note(note)
-            pitches_written[note.midi_pitch] = True
-        for pitch in sounding_notes:
-            if sounding_notes[pitch]:
-                if not pitches_written[pitch]:
-                    event.append_note(Note(pitch, tie_from_previous=True))
-                    pitches_written[pitch] = True
+    def _parse_midi_tracks(ticks_per_beat, tracks):
+        """Collects the notes of each instrument from the tracks returned by _read_midi_file, all
+        in ticks. Splits the tracks into instruments and pairs note on and off events the same way
+        as PrettyMIDI, and finds the same measures as PrettyMIDI.get_downbeats.
+
+        returns: a tuple (instruments, downbeat_ticks, time_signatures) as needed by _build_song,
+                 or None if PrettyMIDI would find other measures than _get_downbeats, or would
+                 not load the file at all.
+        """
+        if any(last_tick >= _MAX_TICK for _, _, last_tick in tracks):
+            return None
+
+        end_tick = 0
+        controls_end_tick = 0
+        tick_scale = 60.0 / (120.0 * ticks_per_beat)
+        time_signature_changes = []
+        instruments = []
+        for track_idx, (channel_events, meta_events, _) in enumerate(tracks):
+            track_names = []  # (index, name) of each track name event
+            for index, tick, meta_type, value in meta_events:
+                if meta_type == 0x03:  # track name
+                    track_names.append((index, value))
+                elif meta_type in (0x01, 0x05):  # text, lyrics
+                    end_tick = max(end_tick, tick)
+                elif track_idx == 0:
+                    if meta_type == 0x58:  # time signature
+                        time_signature_changes.append((tick,) + value)
+                        end_tick = max(end_tick, tick)
+                    elif meta_type == 0x59:  # key signature
+                        end_tick = max(end_tick, tick)
+                    elif meta_type == 0x51:  # tempo
+                        if value == 0:
+                            return None
+                        new_tick_scale = 60.0 / ((6e7 / value) * ticks_per_beat)
+                        # PrettyMIDI ignores repeated tempos, so they don't extend the song.
+                        if tick > 0 and new_tick_scale != tick_scale:
+                            end_tick = max(end_tick, tick)
+                        tick_scale = new_tick_scale
+
+            # All ticks are below _MAX_TICK, so they fit in int32.
+            ticks, statuses, data1, data2 = np.array(channel_events,
+                                                     dtype=np.int32).reshape(-1, 4).T
+            message_types = statuses & 0xf0
+            channels = statuses & 0x0f
+            controls = (message_types == 0xb0) | (message_types == 0xe0)
+            if controls.any():
+                controls_end_tick = max(controls_end_tick, int(ticks[controls].max()))
+
+            notes = SongMidiConverter._pair_notes(ticks, message_types, channels, data1, data2)
+            if notes is None:
+                notes = SongMidiConverter._pair_notes_sequentially(channel_events)
+            off_indices, starts, ends, pitches, velocities, note_channels = notes
+            if not len(off_indices):
+                continue
+            end_tick = max(end_tick, int(ends.max()))
+
+            # Like PrettyMIDI, a note belongs to the instrument of the program of its channel at
+            # its note off.
+            programs = np.zeros(len(off_indices), dtype=np.int32)
+            program_changes = np.flatnonzero(message_types == 0xc0)
+            for channel in np.unique(channels[program_changes]).tolist():
+                changes = program_changes[channels[program_changes] == channel]
+                change_idx = np.searchsorted(changes, off_indices) - 1
+                selected = (note_channels == channel) & (change_idx >= 0)
+                programs[selected] = data1[changes[change_idx[selected]]]
+
+            # The notes are ordered by note off. Create the instruments in order of their first
+            # note, which is when PrettyMIDI creates them, and with the track name at that point.
+            _, first_notes, note_instruments = np.unique(programs * 16 + note_channels,
+                                                         return_index=True, return_inverse=True)
+            for instrument in np.argsort(first_notes).tolist():
+                first_note = first_notes[instrument]
+                name = ''
+                for index, track_name in track_names:
+                    if index <= off_indices[first_note]:
+                        name = track_name
+                program = int(programs[first_note])
+                is_drum = int(note_channels[first_note]) == _DRUM_CHANNEL
+                selected = note_instruments == instrument
+                instruments.append((name, program, is_drum,
+                                    TrackType.DRUMS if is_drum else TrackType.UNKNOWN,
+                                    (starts[selected], ends[selected], pitches[selected],
+                                     velocities[selected])))
+
+        # PrettyMIDI only counts control changes and pitch bends towards the end of the song if
+        # they belong to an instrument with notes.
+        if controls_end_tick > end_tick:
+            return None
+
+        downbeats = SongMidiConverter._get_downbeats(time_signature_changes, ticks_per_beat,
+                                                     end_tick)
+        if downbeats is None:
+            return None
+        return (instruments,) + downbeats
+
+    @staticmethod
+    def _pair_notes(ticks, message_types, channels, pitches, velocities):
+        """Pairs the note on and off events of a track, given as arrays of the channel events
+        returned by _read_midi_file. Handles the usual case in NumPy: for each channel and pitch,
+        the events alternate between note on and note off, starting with a note on, and each note
+        ends after it starts. Returns None for any other track.
+
+        returns: a tuple of arrays (off_indices, start_ticks, end_ticks, pitches, velocities,
+                 channels), with a row per note, sorted by the index of the note off event.
+        """
+        is_note_on = (message_types == 0x90) & (velocities > 0)
+        note_events = np.flatnonzero(is_note_on | (message_types == 0x80)
+                                     | (message_types == 0x90))
+        keys = channels[note_events] * 128 + pitches[note_events]
+        # Group the events by channel and pitch, keeping their order within the group.
+        order = np.argsort(keys, kind='stable')
+        note_events = note_events[order]
+        keys = keys[order]
+        if len(note_events) % 2:
+            return None
+        on_indices = note_events[0::2]
+        off_indices = note_events[1::2]
+        if (not is_note_on[on_indices].all() or is_note_on[off_indices].any()
+                or (keys[0::2] != keys[1::2]).any()
+                or (ticks[off_indices] <= ticks[on_indices]).any()):
+            return None
+
+        by_note_off = np.argsort(off_indices)
+        on_indices = on_indices[by_note_off]
+        off_indices = off_indices[by_note_off]
+        return (off_indices, ticks[on_indices], ticks[off_indices],
+                pitches[on_indices].astype(np.uint8), velocities[on_indices].astype(np.uint8),
+                channels[on_indices])
+
+    @staticmethod
+    def _pair_notes_sequentially(channel_events):
+        """Pairs the note on and off events of a track one event at a time, exactly like
+        PrettyMIDI. Handles any track, including overlapping notes of the same pitch, spurious
+        note offs and notes without length. Returns the same arrays as _pair_notes."""
+        off_indices = []
+        starts = []
+        ends = []
+        pitches = []
+        velocities = []
+        channels = []
+        # Note on events that are still open, keyed by (channel, pitch).
+        open_notes = {}
+        for index, (tick, status, pitch, velocity) in enumerate(channel_events):
+            message_type = status & 0xf0
+            channel = status & 0x0f
+            if message_type == 0x90 and velocity > 0:
+                open_notes.setdefault((channel, pitch), []).append((tick, velocity))
+            elif message_type in (0x80, 0x90):
+                key = (channel, pitch)
+                notes = open_notes.get(key)
+                if notes is None:
+                    continue  # Spurious note off.
+                # A note off closes all open notes of its pitch, except those that start at the
+                # same tick.
+                notes_to_close = [note for note in notes if note[0] != tick]
+                if notes_to_close and len(notes_to_close) < len(notes):
+                    open_notes[key] = [note for note in notes if note[0] == tick]
+                else:
+                    del open_notes[key]
+                for start, note_velocity in notes_to_close:
+                    off_indices.append(index)
+                    starts.append(start)
+                    ends.append(tick)
+                    pitches.append(pitch)
+                    velocities.append(note_velocity)
+                    channels.append(channel)
+
+        return (np.array(off_indices, dtype=np.int64), np.array(starts, dtype=np.int32),
+                np.array(ends, dtype=np.int32), np.array(pitches, dtype=np.uint8),
+                np.array(velocities, dtype=np.uint8), np.array(channels, dtype=np.int32))
+
+    @staticmethod
+    def _get_downbeats(time_signature_changes, ticks_per_beat, end_tick):
+        """Computes the measures of a song in ticks, matching PrettyMIDI.get_downbeats.
+
+        params:
+            time_signature_changes: list of (tick, numerator, denominator) tuples.
+            end_tick: the tick of the last event. Measures start before this tick.
+
+        returns: a tuple (downbeat_ticks, time_signatures) of the start tick and TimeSignature of
+                 each measure, or None if PrettyMIDI's beat tracking doesn't reduce to whole
+                 ticks for these time signatures (see PrettyMIDI.get_beats).
+        """
+        def beat_ticks(numerator, denominator):
+            """Length of a beat in PrettyMIDI.get_beats, or None if it isn't a whole number of
+            ticks."""
+            if denominator not in (1, 2, 4, 8, 16, 32) or 4 * ticks_per_beat % denominator != 0:
+                return None
+            if numerator % 3 == 0 and numerator != 3:
+                return 12 * ticks_per_beat // denominator  # compound meter
+            return 4 * ticks_per_beat // denominator
+
+        changes = sorted(time_signature_changes)
+        beats = [beat_ticks(numerator, denominator) for _, numerator, denominator in changes]
+        if None in beats:
+            return None
+        if not changes or changes[0][0] > 0:
+            # PrettyMIDI counts 4/4 measures until the first time signature, but in beats of the
+            # first time signature.
+            if changes and beats[0] != ticks_per_beat:
+                return None
+            changes.insert(0, (0, 4, 4))
+            beats.insert(0, ticks_per_beat)
+
+        downbeat_ticks = []
+        time_signatures = []
+        span_ends = [change[0] for change in changes[1:]] + [end_tick]
+        last_span = len(changes) - 1
+        for span, ((start, numerator, denominator), beat, span_end) in enumerate(
+                zip(changes, beats, span_ends)):
+            if span == last_span:
+                if start >= end_tick > 0:
+                    return None  # PrettyMIDI doesn't find the beat of this time signature.
+            elif start >= span_end or (span_end - start) % beat != 0:
+                return None  # Several time signatures at one tick, or one that is not on a beat.
+            measures = range(start, span_end, numerator * 4 * ticks_per_beat // denominator)
+            downbeat_ticks.extend(measures)
+            time_signatures.extend([TimeSignature(numerator, denominator)] * len(measures))
+        return np.array(downbeat_ticks, dtype=np.int64), time_signatures
+
+    @staticmethod
+    def _get_measure_numbers(ticks, downbeat_ticks):
+        """Returns an array of the index of the measure containing each of the given ticks, i.e.
+        the index of the last downbeat at or before it. downbeat_ticks must be sorted."""
+        measure_numbers = np.searchsorted(downbeat_ticks, ticks, side='right') - 1
+        if len(measure_numbers) and measure_numbers[0] < 0:
+            # Not found. ticks are sorted, so only the first one can be before the first downbeat.
+            raise Exception('measure number not found for tick %d\nDownbeats: %s'
+                            % (ticks[0], downbeat_ticks))
+        return measure_numbers
+
+    @staticmethod
+    def _times_to_ticks(midi, times):
+        """Vectorized version of PrettyMIDI.time_to_tick: converts an array of times in seconds to
+        an int64 array of absolute ticks, rounding each time to the nearest tick. Works from the
+        song's tempo changes, extrapolating after the last one as time_to_tick does."""
+        change_times, tempi = midi.get_tempo_changes()
+        tick_scales = 60.0 / (tempi * midi.resolution)  # Seconds per tick after each change.
+        # PrettyMIDI puts the first tempo change at tick 0; the others follow from the lengths of
+        # the tempo segments before them, which are whole numbers of ticks.
+        change_ticks = np.zeros(len(change_times))
+        change_ticks[1:] = np.cumsum(np.round(np.diff(change_times) / tick_scales[:-1]))
+
+        times = np.asarray(times, dtype=np.float64)
+        changes = np.maximum(np.searchsorted(change_times, times, side='right') - 1, 0)
+        ticks = change_ticks[changes] + (times - change_times[changes]) / tick_scales[changes]
+        return np.round(ticks).astype(np.int64)
+
+    @staticmethod
+    def _get_note_arrays(midi, instrument):
+        """Returns the notes of a PrettyMIDI instrument as parallel arrays
+        (start_ticks, end_ticks, pitches, velocities). pitches and velocities are uint8."""
+        notes = instrument.notes
+        num_notes = len(notes)
+        starts = np.fromiter((note.start for note in notes), dtype=np.float64, count=num_notes)
+        ends = np.fromiter((note.end for note in notes), dtype=np.float64, count=num_notes)
+        pitches = np.fromiter((note.pitch for note in notes), dtype=np.uint8, count=num_notes)
+        velocities = np.fromiter((note.velocity for note in notes), dtype=np.uint8,
+                                 count=num_notes)
+        ticks = SongMidiConverter._times_to_ticks(midi, np.concatenate((starts, ends)))
+        return ticks[:num_notes], ticks[num_notes:], pitches, velocities
+
+    @staticmethod
+    def _get_events(notes, downbeat_ticks):
+        """Return the note and measure events of an instrument as parallel arrays
+        (ticks, event_types, pitches, velocities). notes holds the instrument's notes as returned
+        by _get_note_arrays. downbeat_ticks holds the tick of each measure start, shared by all
+        instruments. pitch and velocity are 0 for MEASURE_START events.
+
+        The events are sorted first by tick and second by event type. Thus, for events at the same
+        tick, NOTE_OFF events are listed first, then MEASURE_START, and finally NOTE_ON. Ties are
+        broken by pitch."""
+        start_ticks, end_ticks, note_pitches, note_velocities = notes
+        num_notes = len(start_ticks)
+        num_downbeats = len(downbeat_ticks)
+
+        # Use the smallest dtypes that fit, which makes sorting faster.
+        ticks = np.concatenate((start_ticks, end_ticks, downbeat_ticks))
+        ticks = ticks.astype(_tick_dtype(ticks.max(initial=0)), copy=False)
+        event_types = np.repeat(
+            np.array([_EventType.NOTE_ON, _EventType.NOTE_OFF, _EventType.MEASURE_START],
+                     dtype=np.uint8),
+            (num_notes, num_notes, num_downbeats))
+        pitches = np.concatenate((note_pitches, note_pitches, np.zeros(num_downbeats, np.uint8)))
+        velocities = np.concatenate((note_velocities,
+                                     np.zeros(num_notes + num_downbeats, np.uint8)))
+
+        order = np.lexsort((pitches, event_types, ticks))
+        return ticks[order], event_types[order], pitches[order], velocities[order]
+
+    @staticmethod
+    def _write_event(pending, pending_velocities, sounding, note_pitches, note_velocities,
+                     note_ties):
+        """Append the notes of an event to the note lists: the pending notes, and a
+        tie_from_previous note for every other sounding note. The notes are added in pitch order.
+
+        pending and sounding are bitmaps (ints) with bit p set for each pending or sounding midi
+        pitch p. Pending notes are always sounding. pending_velocities holds the velocity of each
+        pending note, indexed by midi pitch."""
+        remaining = sounding
+        while remaining:
+            lowest_bit = remaining & -remaining
+            pitch = lowest_bit.bit_length() - 1
+            note_pitches.append(pitch)
+            if pending & lowest_bit:
+                note_velocities.append(pending_velocities[pitch])
+                note_ties.append(False)
+            else:
+                note_velocities.append(-1)
+                note_ties.append(True)
+            remaining ^= lowest_bit
+
+    @staticmethod
+    def _merge_events(ticks, event_types, pitches, velocities):
+        """Merge the sorted note and measure events returned by _get_events into Song events.
+
+        The events have been sorted by tick and by event type, so for each tick, we can easily
+        process all note-off events, then all measure boundaries, and then all note on events.
+        This allows us to chop up long notes into notes that restart at each measure boundary with
+        a "tie-to-previous" marker. Similarly, all notes are split (with a tie-to previous marker)
+        any time other notes end. The effect is that there is a new Song event at any point that
+        the set of notes changes or we cross a measure boundary.
+          We keep track of all currently-sounding notes so that we can generate any required
+        tie-to-previous notes at each event time point.
+
+        Only works on plain ints, and does not create any Song objects.
+
+        returns: a tuple of lists (event_ticks, event_durations, note_offsets, note_pitches,
+                 note_velocities, note_ties). Song event i starts at event_ticks[i], has duration
+                 event_durations[i], and contains the notes at indices note_offsets[i] to
+                 note_offsets[i + 1] of the note lists.
+        """
+        event_ticks = []
+        event_durations = []
+        note_offsets = [0]
+        note_pitches = []
+        note_velocities = []
+        note_ties = []
+
+        # Bitmap of the sounding midi pitches.
+        sounding = 0
+        prev_tick = 0
+        # Bitmap of the notes that start at the next event, and their velocities, indexed by midi
+        # pitch. All other sounding notes are added to the event as tie_from_previous notes.
+        pending = 0
+        pending_velocities = [0] * 128
+
+        for tick, event_type, pitch, velocity in zip(ticks.tolist(), event_types.tolist(),
+                                                     pitches.tolist(), velocities.tolist()):
+            if tick > prev_tick:
+                # We have moved on to a new tick. Generate the event for the previous tick.
+                event_ticks.append(prev_tick)
+                event_durations.append(tick - prev_tick)
+                SongMidiConverter._write_event(pending, pending_velocities, sounding,
+                                               note_pitches, note_velocities, note_ties)
+                note_offsets.append(len(note_pitches))
+
+                # Start a new set of pending notes.
+                pending = 0
+
+            # MEASURE_START events need no handling: they only end the previous event.
+            if event_type == _EventType.NOTE_OFF:
+                # This is like a Measure start event, but we don't know how many notes
+                # will be turned off. The notes that keep sounding will tie-from-previous in the
+                # next event, just like at a measure break.
+                #   The note may have been removed already if there are multiple NOTE_ON MIDI
+                # events with a single NOTE_OFF; pretty midi will result in multiple NOTE_OFF
+                # events in this case at the same time.
+                pending &= ~(1 << pitch)
+                sounding &= ~(1 << pitch)
+
+            elif event_type == _EventType.NOTE_ON:
+                # New note.
+                # If note was already sounding, replace any existing tie_from_previous version.
+                pending |= 1 << pitch
+                pending_velocities[pitch] = velocity
+                sounding |= 1 << pitch
+
+            prev_tick = tick
+
+        # Make sure no notes are still sounding.
+        assert not sounding
+
+        return (event_ticks, event_durations, note_offsets, note_pitches, note_velocities,
+                note_ties)
+
+    @staticmethod
+    def _prepare_track(notes, downbeat_ticks):
+        """Returns the Song events of an instrument as the lists returned by _merge_events, except
+        that the event start ticks are replaced by the index of each event's measure."""
+        events = SongMidiConverter._get_events(notes, downbeat_ticks)
+        event_ticks, *merged_events = SongMidiConverter._merge_events(*events)
+        # MEASURE_START events split the Song events at each downbeat, so each event lies within
+        # one measure, which can be looked up from its start tick.
+        event_measures = SongMidiConverter._get_measure_numbers(event_ticks, downbeat_ticks)
+        return (event_measures.tolist(), *merged_events)
 
     #TODO: add metadata (midi_path, h5_path, original key?), add to song Class
     @staticmethod
@@ -220,110 +836,66 @@ class SongMidiConverter():
 
         returns: a Song object containing the given Instruments as Tracks.
         """
+        from pretty_midi import PrettyMIDI, Instrument
+        from pysong.pretty_midi_utils import get_all_time_signatures
+
         assert isinstance(midi, PrettyMIDI)
 
         downbeats = midi.get_downbeats()
-        song = Song(name, midi.resolution)
 
-        # Convert each pretty_midi Instrument into a Song track.
-        # N.B. This may change the order of tracks relative to the original MIDI file, and it
-        # forces each instrument onto a different channel, which might make us run out of MIDI
-        # channels.
-        channel = 0
+        # The measures are the same for all tracks, so convert them once.
+        downbeat_ticks = SongMidiConverter._times_to_ticks(midi, downbeats)
+
+        # Get the list of time signatures, one for each measure.
+        time_signatures = get_all_time_signatures(midi, downbeats)
+
+        instruments = []
         for instrument, track_type in instrument_and_type_list:
             assert isinstance(instrument, Instrument)
             assert isinstance(track_type, TrackType)
+            instruments.append((instrument.name, instrument.program, instrument.is_drum,
+                                track_type, SongMidiConverter._get_note_arrays(midi, instrument)))
 
-            if instrument.is_drum:
+        return SongMidiConverter._build_song(name, midi.resolution, instruments, downbeat_ticks,
+                                             time_signatures)
+
+    @staticmethod
+    def _build_song(name, ticks_per_beat, instruments, downbeat_ticks, time_signatures):
+        """Create a new Song with a Track for each instrument.
+
+        params:
+            instruments: a list of tuples of (name, program, is_drum, song_elements.TrackType,
+                         notes), where notes is a tuple of arrays as returned by _get_note_arrays.
+            downbeat_ticks: array of the start tick of each measure.
+            time_signatures: list of the TimeSignature of each measure.
+        """
+        song = Song(name, ticks_per_beat)
+
+        # Convert each instrument into a Song track.
+        # N.B. This may change the order of tracks relative to the original MIDI file, and it
+        # forces each instrument onto a different channel, which might make us run out of MIDI
+        # channels.
+        channel = 0
+        for instrument_name, program, is_drum, track_type, notes in instruments:
+            if is_drum:
                 this_channel = _DRUM_CHANNEL
             else:
                 this_channel = channel
 
-            track = song.new_track(instrument.name, instrument.program, this_channel, track_type)
-
-            # Generate set of event times with associated events.
-            events = SongMidiConverter._get_events(instrument, downbeats, midi)
-
-            # Get the list of time signatures, one for each measure.
-            time_signatures = get_all_time_signatures(midi, downbeats)
-
-            # The events have been sorted by tick and by event type, so for each tick, we can
-            # easily process all note-off events, then all measure boundaries, and then all note on
-            # events. This allows us to chop up long notes into notes that restart at each measure
-            # boundary with a "tie-to-previous" marker. Similarly, all notes are split (with a
-            # tie-to previous marker) any time other notes end. The effect is that there is a new
-            # Song event at any point that the set of notes changes or we cross a measure boundary.
-            #   We keep track of all currently-sounding notes so that we can generate any required
-            # tie-to-previous notes at each event time point.
-
-            # key is the midi pitch; value is True if sounding
-            sounding_notes = defaultdict(bool)
-            prev_tick = 0
-            measure_idx = -1
-            current_measure = None
-            notes_to_add = []  # list of song_elements.Note objects
-
-            first_note_off_at_tick = True
-            for tick, event_type, note in events:  # note is a pretty_midi note
-                if tick > prev_tick:
-                    # We have moved on to a new tick. Generate the event in the previous measure.
-                    delta_duration = tick - prev_tick
-                    SongMidiConverter._write_event(delta_duration, current_measure, notes_to_add,
-                                                   sounding_notes)
-
-                    # Make new notes_to_add list of song_elements.Note objects.
-                    notes_to_add = []
-
-                    # Reset first-note-off flag.
-                    first_note_off_at_tick = True
-
-                if event_type == _EventType.NOTE_OFF:
-                    # This is like a Measure start event, but we don't know how many notes
-                    # will be turned off.
-                    #   We need to record all note-off events, and then prepare a new note
-                    # event with tie_from_previous set for all pitches.
-                    if first_note_off_at_tick:
-                        first_note_off_at_tick = False
-                        # Add all currently sounding notes to notes_to_add, but then start removing
-                        # them for each note_off. Added notes will tie-from-previous. This is just
-                        # like a measure break.
-                        for pitch in sounding_notes:
-                            if sounding_notes[pitch]:
-                                notes_to_add.append(Note(pitch, tie_from_previous=True))
-
-                    # Remove note from notes_to_add if it exists (it might have been deleted
-                    # already if there are multiple NOTE_ON MIDI events with a single NOTE_OFF);
-                    # pretty midi will result in multiple NOTE_OFF events in this case at the
-                    # same time.
-                    for i, note_to_add in enumerate(notes_to_add):
-                        if note_to_add.midi_pitch == note.pitch:
-                            del notes_to_add[i]
-                            break
-
-                    sounding_notes[note.pitch] = False
-
-                elif event_type == _EventType.MEASURE_START:
-                    # Move to next measure.
-                    measure_idx += 1
-                    current_measure = track.new_measure(time_signatures[measure_idx])
-
-                elif event_type == _EventType.NOTE_ON:
-                    # New note.
-                    # If note was already sounding, replace any existing tie_from_previous version.
-                    remove_idx = None
-                    for idx, added_note in enumerate(notes_to_add):
-                        if added_note.midi_pitch == note.pitch:
-                            remove_idx = idx
-                    if remove_idx is not None:
-                        del notes_to_add[remove_idx]
-                    notes_to_add.append(Note(note.pitch, note.velocity))
-                    sounding_notes[note.pitch] = True
-
-                prev_tick = tick
-
-            # Make sure no notes are still sounding.
-            for sounding in sounding_notes.values():
-                assert not sounding
+            track = song.new_track(instrument_name, program, this_channel, track_type)
+
+            (event_measures, event_durations, note_offsets, note_pitches, note_velocities,
+             note_ties) = SongMidiConverter._prepare_track(notes, downbeat_ticks)
+
+            measures = track.new_measures(time_signatures)
+            for measure_idx, duration, start, end in zip(event_measures, event_durations,
+                                                         note_offsets, note_offsets[1:]):
+                event = measures[measure_idx].new_event(duration)
+                for pitch, velocity, tie_from_previous in zip(note_pitches[start:end],
+                                                              note_velocities[start:end],
+                                                              note_ties[start:end]):
+                    event.append_note(_TIE_NOTES[pitch] if tie_from_previous
+                                      else Note(pitch, velocity))
 
             channel += 1
             if channel == _DRUM_CHANNEL:  # skip drum channel
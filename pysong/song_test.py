@@ -1,18 +1,32 @@
+import base64
+import io
 import os
+import struct
 import unittest
 import tempfile
 
-from mido import MidiFile
+from mido import MidiFile, MidiTrack
 from mido.messages import Message
 from mido.midifiles.meta import MetaMessage
-from pretty_midi import PrettyMIDI
 
-from pysong.pretty_midi_utils import is_monophonic, get_all_time_signatures
 from pysong.song import Song
 from pysong.song_elements import TrackType, TimeSignature, Key, Mode, Measure, Event, Note
 from pysong.song_midi_converter import SongMidiConverter
 
 
+# A gzipped pickle of a song saved by Song.save before the .npz format: two tracks (the second
+# named None) with notes, a tie and a rest, made with the original dict-based classes.
+_LEGACY_SONG = base64.b64decode(
+    'H4sIAAAAAAACA11Sz2sUMRReO7M7+6MtCOJNof6ALUgLgiDYehA82Ngidk+ChOzsc1/oTjJkMgtzEPQgKOTW+Pfq'
+    'S3a6U81hkpe8933f++Z96//eTXpxuUnZVFotj8LHu/QybNf+8Lv/6qcuVaIA7wbvYSnyxrt9KwvglVwqYWtDL/du'
+    'VXNYQQHKVt7tzSjvcpu2xRupugAjrDaeJW6yAKULqTZxWs9dcgWNx6FLGO2dikIvIFyn5+Fw7dmdH/6jd3etVjLn'
+    'pbQ58nwlqsqzjFAG1oj8qvKf/ZSK+rMQbdGw79I3IdVlpdFLIwrPDlyWo1AKVgTtxrGc26aMpKNYPwsRMSeReVIK'
+    'Q53yaBombliAqKjTwEkl2fkm7FoYwDo600p6G6Luta+0valNL+jcPY0LuZCbFj2buuEaVjqXtvHsE/UvgX8xuuCl'
+    'gbXUdeV/1XPhhouaPJZaRVPxedv4i0D+sg1esSmenP2hhac/Kam7P8YT9gFPCQnw9f8Amxtw48oKY7mV5Czrud3W'
+    'j+icx4eY4YSUUO2DG9cv8ID18BEb4WN8ytJgI04xwUMCfdYmHdP5Nlkn6gmJWkRRgiTshO0dwZ0hI6pxm7bHdnA/'
+    '6IvUEKaVxoCXYPgchCU33P1/B5iH376M1tfzo78tHCSZFwMAAA==')
+
+
 class Test_song(unittest.TestCase):
     @staticmethod
     def make_song_empty():
@@ -41,28 +55,30 @@ class Test_song(unittest.TestCase):
     @staticmethod
     def make_song(num_tracks, num_measures, include_drums=False):
         s = Song('Random Song')
+        # Event durations: a beat, half a beat, a quarter beat, ...
+        durations = [s.ticks_per_beat >> k for k in range(num_tracks)]
         for i in range(num_tracks):
             if include_drums and i == num_tracks-1:
                 # Make a drum track.
                 track = s.new_track('Drums', 0, 9, TrackType.DRUMS)
-                for j in range(num_measures):
-                    measure = track.new_measure()
+                for measure in track.new_measures([None] * num_measures):
                     for k in range(num_tracks):
-                        event = measure.new_event(s.ticks_per_beat / (2**k))
+                        event = measure.new_event(durations[k])
                         for m in range(k):
                             if k % (1+m) == 0:
                                 event.new_note(41 - m, 64 + 16 * m)
             else:
                 # Make a pitched track.
                 track = s.new_track('Track %d' % i, i, i)
-                for j in range(num_measures):
-                    measure = track.new_measure()
+                pitch = 72 - 3 * i
+                velocity = 64 + 16 * i
+                for measure in track.new_measures([None] * num_measures):
                     for k in range(i+1):
-                        event = measure.new_event(s.ticks_per_beat / (2**k))
+                        event = measure.new_event(durations[k])
                         if k % 3 < 1:
-                            event.new_note(72 - 3 * i, 64 + 16 * i)
+                            event.new_note(pitch, velocity)
                         if k % 3 < 2:
-                            event.new_note(72 - 3 * i - 3 * (k+1), 64 + 16 * i)
+                            event.new_note(pitch - 3 * (k+1), velocity)
         return s
 
     @staticmethod
@@ -131,7 +147,8 @@ class Test_song(unittest.TestCase):
     def test_song_save_load(self):
         """Make a Song and save to a temp file."""
         song1 = self.make_song_empty()
-        filename = tempfile.mktemp()
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            filename = f.name
         song1.save(filename)
 
         # Delete the original!
@@ -145,24 +162,119 @@ class Test_song(unittest.TestCase):
 
         self.assertEqual(str(song2), 'Song: Test2. 1 track. Time signature: 3/8. Key: G MINOR')
 
+    def test_song_save_load_notes(self):
+        """Save and load a Song with notes, ties and rests."""
+        song1 = self.make_song(3, 2)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            filename = f.name
+        song1.save(filename)
+        song2 = Song.load(filename)
+        os.remove(filename)
+
+        self.assertEqual(song1, song2)
+
+    def test_song_save_load_file_object(self):
+        song1 = self.make_song(2, 2)
+        song1.tracks[0].name = None
+        buffer = io.BytesIO()
+        song1.save(buffer)
+        buffer.seek(0)
+        song2 = Song.load(buffer)
+        self.assertEqual(song1, song2)
+        self.assertIsNone(song2.tracks[0].name)
+
+    def test_song_load_legacy_pickle(self):
+        song = Song.load(io.BytesIO(_LEGACY_SONG))
+        self.assertEqual(str(song), 'Song: Legacy. 2 tracks. Time signature: 3/4. Key: G MINOR')
+        bass, drums = song.tracks
+        self.assertEqual((bass.name, bass.program, bass.channel, bass.track_type),
+                         ('Bass', 33, 1, TrackType.BASS))
+        self.assertIsNone(drums.name)
+        self.assertEqual(drums.measures[0].time_signature, TimeSignature(2, 4))
+        self.assertEqual([event.notes for event in bass.measures[0]],
+                         [[Note(40, 90)], [Note(40, -1, True), Note(47, 80)], []])
+
+    def test_song_save_invalid_time_signature_changes(self):
+        song = self.make_song_empty()
+        song.time_signature_changes = [(0, TimeSignature(3, 4))]
+        with self.assertRaises(ValueError):
+            song.save(io.BytesIO())
+
+    def test_song_eq_unnamed_track(self):
+        song1 = Song('Unnamed')
+        song1.new_track(None, 0, 0)
+        song1.new_track('Named', 1, 1)
+        song2 = Song('Unnamed')
+        song2.new_track('Named', 1, 1)
+        song2.new_track(None, 0, 0)
+        self.assertEqual(song1, song2)
+
+    def test_measure_duration_ticks_per_beat(self):
+        song = Song('Ticks', ticks_per_beat=4)
+        measure = song.new_track('Track', 0, 0).new_measure(TimeSignature(3, 4))
+        self.assertEqual(measure.get_duration_ticks(), 12)
+        song.ticks_per_beat = 8
+        self.assertEqual(measure.get_duration_ticks(), 24)
+
+    def test_new_measure_after_edit(self):
+        track = Song('Edited').new_track('Track', 0, 0)
+        measure = track.new_measure()
+        measure.time_signature = TimeSignature(3, 4)
+        self.assertEqual(track.new_measure().start_tick, 1440)
+        track.measures[-1].start_tick = 2000
+        self.assertEqual(track.new_measures([None])[0].start_tick, 3920)
+
+    def test_track_note_array(self):
+        track = self.make_song_with_ties().tracks[0]
+        notes = track.note_array()
+        self.assertEqual(len(notes), sum(len(event.pitches) for measure in track
+                                         for event in measure))
+
+        # Third event: a new note, and ties from the notes of the previous two events.
+        event_notes = notes[notes['event_tick'] == 2 * 480]
+        self.assertEqual(event_notes['measure_idx'].tolist(), [0, 0, 0])
+        self.assertEqual(event_notes['duration'].tolist(), [480, 480, 480])
+        self.assertEqual(event_notes['pitch'].tolist(), [52, 50, 48])
+        self.assertEqual(event_notes['velocity'].tolist(), [64, -1, -1])
+        self.assertEqual(event_notes['tie'].tolist(), [False, True, True])
+
+        self.assertEqual(len(self.make_song_empty().tracks[0].note_array()), 0)
+
+    def test_event_notes_read_only(self):
+        song1 = self.make_song_with_ties()
+        song2 = self.make_song_with_ties()
+        event = song1.tracks[0].measures[0].events[1]
+        self.assertEqual(event, song2.tracks[0].measures[0].events[1])
+        with self.assertRaises(TypeError):
+            event.pitches[0] = 50
+        with self.assertRaises(TypeError):
+            event.ties[1] = 0
+        event.set_ties([0, 0])
+        self.assertNotEqual(event, song2.tracks[0].measures[0].events[1])
+        self.assertEqual(event.tied_pitches, frozenset())
+
     def song_to_midi_to_song(self, song):
         """Make a song and export to midi."""
-        filename = tempfile.mktemp() + '.mid'
-        SongMidiConverter.export_midi(song, filename)
+        midi_buffer = io.BytesIO()
+        SongMidiConverter.export_midi(song, midi_buffer)
 
         # Read back from MIDI.
-        song2 = SongMidiConverter.create_song_from_midi(filename)
+        midi_buffer.seek(0)
+        song2 = SongMidiConverter.create_song_from_midi(midi_buffer)
         song2.name = song.name
 
-        # Clean up.
-        os.remove(filename)
-
         print ('imported song:')
         song2.print_tracks(True)
 
         # Compare the two versions.
         self.assertEqual(song, song2)
 
+    def test_export_invalid_pitch(self):
+        song = Song('Invalid')
+        song.new_track('Track', 0, 0).new_measure().new_event(480).new_note(-1, 100)
+        with self.assertRaises(ValueError):
+            SongMidiConverter.export_midi(song, io.BytesIO())
+
     def test_empty_song_to_midi_to_song(self):
         self.song_to_midi_to_song(Song())
 
@@ -181,73 +293,81 @@ class Test_song(unittest.TestCase):
     def test_song_to_midi_to_song_ties_2(self):
         self.song_to_midi_to_song(self.make_song_with_ties_2())
 
+    # (type, note, velocity, delta time) of the note messages in create_midi_file.
+    _BASS_LINE_EVENTS = (
+        ('note_on', 33, 127, 6154),
+        ('note_off', 33, 0, 185),
+        ('note_on', 33, 127, 1),
+        ('note_off', 33, 0, 154),
+        ('note_on', 33, 127, 0),
+        ('note_off', 33, 0, 145),
+        ('note_on', 33, 127, 0),
+        ('note_off', 33, 0, 172),
+        ('note_on', 33, 127, 0),
+        ('note_off', 33, 0, 96),
+
+        ('note_on', 29, 127, 0),
+        ('note_off', 29, 0, 207),
+        ('note_on', 29, 127, 0),
+        ('note_off', 29, 0, 146),
+
+        ('note_on', 31, 127, 0),
+        ('note_off', 31, 0, 140),
+        ('note_on', 31, 127, 1),
+        ('note_off', 31, 0, 167),
+        ('note_on', 31, 127, 1),
+        ('note_off', 31, 0, 83),
+
+        ('note_on', 33, 127, 0),
+        ('note_off', 33, 0, 216),
+        ('note_on', 33, 127, 1),
+        ('note_off', 33, 0, 162),
+        ('note_on', 33, 127, 1),
+        ('note_off', 33, 0, 140),
+    )
+
     @staticmethod
     def create_midi_file():
         midifile = MidiFile(ticks_per_beat=192)
-        track = midifile.add_track('main bass')
-        track.append(Message('program_change', channel=0, program=3, time=0))
-        track.append(MetaMessage('time_signature', numerator=4, denominator=4))
-
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=6154))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=185))
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=1))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=154))
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=145))
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=172))
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=96))
-
-        track.append(Message('note_on', channel=0, note=29, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=29, velocity=0, time=207))
-        track.append(Message('note_on', channel=0, note=29, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=29, velocity=0, time=146))
-
-        track.append(Message('note_on', channel=0, note=31, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=31, velocity=0, time=140))
-        track.append(Message('note_on', channel=0, note=31, velocity=127, time=1))
-        track.append(Message('note_off', channel=0, note=31, velocity=0, time=167))
-        track.append(Message('note_on', channel=0, note=31, velocity=127, time=1))
-        track.append(Message('note_off', channel=0, note=31, velocity=0, time=83))
-
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=216))
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=1))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=162))
-        track.append(Message('note_on', channel=0, note=33, velocity=127, time=1))
-        track.append(Message('note_off', channel=0, note=33, velocity=0, time=140))
+        track = MidiTrack([MetaMessage('track_name', name='main bass'),
+                           Message('program_change', channel=0, program=3, time=0),
+                           MetaMessage('time_signature', numerator=4, denominator=4)])
+        track.extend([Message(message_type, channel=0, note=note, velocity=velocity, time=time)
+                      for message_type, note, velocity, time in Test_song._BASS_LINE_EVENTS])
+        midifile.tracks.append(track)
 
         return midifile
 
     @staticmethod
     def create_midi_file_with_time_signatures():
         midifile = MidiFile(ticks_per_beat=4)  # 1 tick = 1/16th note
-        track = midifile.add_track('main track')
-
-        # 1 empty measure
-
-        # Measure 2: half rest, then 1 quarter notes, then quarter rest
-        track.append(Message('note_on', channel=0, note=60, velocity=127, time=16 + 8))
-        track.append(Message('note_off', channel=0, note=60, velocity=0, time=4))
-
-        # Measure 3: Time signature change to 3/4, then 3 quarter notes
-        track.append(MetaMessage('time_signature', numerator=3, denominator=4, time=4))
-        track.append(Message('note_on', channel=0, note=63, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=63, velocity=0, time=4))
-        track.append(Message('note_on', channel=0, note=64, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=64, velocity=0, time=4))
-        track.append(Message('note_on', channel=0, note=65, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=65, velocity=0, time=4))
-
-        # Measure 4: Time signature change to 5/8, then quarter rest, then 3 eighth notes
-        track.append(MetaMessage('time_signature', numerator=5, denominator=8, time=0))
-        track.append(Message('note_on', channel=0, note=63, velocity=127, time=4))
-        track.append(Message('note_off', channel=0, note=63, velocity=0, time=2))
-        track.append(Message('note_on', channel=0, note=64, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=64, velocity=0, time=2))
-        track.append(Message('note_on', channel=0, note=65, velocity=127, time=0))
-        track.append(Message('note_off', channel=0, note=65, velocity=0, time=2))
+        midifile.tracks.append(MidiTrack([
+            MetaMessage('track_name', name='main track'),
+
+            # 1 empty measure
+
+            # Measure 2: half rest, then 1 quarter notes, then quarter rest
+            Message('note_on', channel=0, note=60, velocity=127, time=16 + 8),
+            Message('note_off', channel=0, note=60, velocity=0, time=4),
+
+            # Measure 3: Time signature change to 3/4, then 3 quarter notes
+            MetaMessage('time_signature', numerator=3, denominator=4, time=4),
+            Message('note_on', channel=0, note=63, velocity=127, time=0),
+            Message('note_off', channel=0, note=63, velocity=0, time=4),
+            Message('note_on', channel=0, note=64, velocity=127, time=0),
+            Message('note_off', channel=0, note=64, velocity=0, time=4),
+            Message('note_on', channel=0, note=65, velocity=127, time=0),
+            Message('note_off', channel=0, note=65, velocity=0, time=4),
+
+            # Measure 4: Time signature change to 5/8, then quarter rest, then 3 eighth notes
+            MetaMessage('time_signature', numerator=5, denominator=8, time=0),
+            Message('note_on', channel=0, note=63, velocity=127, time=4),
+            Message('note_off', channel=0, note=63, velocity=0, time=2),
+            Message('note_on', channel=0, note=64, velocity=127, time=0),
+            Message('note_off', channel=0, note=64, velocity=0, time=2),
+            Message('note_on', channel=0, note=65, velocity=127, time=0),
+            Message('note_off', channel=0, note=65, velocity=0, time=2),
+        ]))
 
         return midifile
 
@@ -312,46 +432,119 @@ class Test_song(unittest.TestCase):
         # Create MIDI file object in memory.
         midifile = Test_song.create_midi_file()
 
-        # Write to file.
-        tmp_midi_orig = tempfile.mktemp() + '.mid'
-        midifile.save(tmp_midi_orig)
-
         # Import to Song object.
-        s = SongMidiConverter.create_song_from_midi(tmp_midi_orig)
+        s = SongMidiConverter.create_song_from_mido(midifile)
 
         # Export to midi.
-        tmp_midi_new = tempfile.mktemp() + '.mid'
-        SongMidiConverter.export_midi(s, tmp_midi_new)
+        midi_new = io.BytesIO()
+        SongMidiConverter.export_midi(s, midi_new)
 
         # Compare original MIDI with exported MIDI.
-        midifile_new = MidiFile(tmp_midi_new)
+        midi_new.seek(0)
+        midifile_new = MidiFile(file=midi_new)
 
         self.assertEqual(len(midifile.tracks), len(midifile_new.tracks))
-        new_track = midifile_new.tracks[0]
-        for i, msg in enumerate(midifile.tracks[0]):
-            self.assertEqual(str(msg), str(new_track[i]))
+        # Messages compare equal when all their attributes, including time, are equal. The new
+        # track also ends with an end_of_track message.
+        orig_track = midifile.tracks[0]
+        self.assertEqual(list(orig_track), list(midifile_new.tracks[0][:len(orig_track)]))
 
-        # Clean up.
-        os.remove(tmp_midi_orig)
-        os.remove(tmp_midi_new)
+    @staticmethod
+    def make_midi_data(ticks_per_beat, *tracks):
+        """Returns the bytes of a format 1 MIDI file. Each track is given as a hex string of its
+        events, so that tests can use encodings that mido doesn't write, like running status."""
+        data = struct.pack('>4sIHHH', b'MThd', 6, 1, len(tracks), ticks_per_beat)
+        for track in tracks:
+            events = bytes.fromhex(track)
+            data += struct.pack('>4sI', b'MTrk', len(events)) + events
+        return data
+
+    def import_like_pretty_midi(self, data):
+        """Imports the bytes of a MIDI file, checking that the file is read directly rather than
+        through PrettyMIDI, and that the result is the same as through PrettyMIDI. Returns the
+        Song."""
+        ticks_per_beat, tracks = SongMidiConverter._read_midi_file(data)
+        self.assertIsNotNone(SongMidiConverter._parse_midi_tracks(ticks_per_beat, tracks))
+        song = SongMidiConverter.create_song_from_midi(io.BytesIO(data))
+        self.assertEqual(song, SongMidiConverter._create_song(None, lambda: data))
+        return song
+
+    def test_import_running_status_and_sysex(self):
+        song = self.import_like_pretty_midi(self.make_midi_data(
+            96,
+            '00 ff 51 03 07 a1 20  00 ff 58 04 04 02 18 08  00 ff 2f 00',
+            # A sysex message, two note ons and their note offs (note ons with velocity 0) in
+            # running status, then a sysex escape and a note with explicit status bytes.
+            '00 c0 05  00 f0 05 7e 7f 09 01 f7  00 90 3c 64  00 40 64  60 3c 00  00 40 00'
+            '  00 f7 02 01 02  60 90 3e 50  60 80 3e 40  00 ff 2f 00'))
+        track, = song.tracks
+        self.assertEqual(track.program, 5)
+        self.assertEqual([event.notes for event in track.measures[0]],
+                         [[Note(60, 100), Note(64, 100)], [], [Note(62, 80)]])
+
+    def test_import_overlapping_and_zero_length_notes(self):
+        song = self.import_like_pretty_midi(self.make_midi_data(
+            96,
+            '00 ff 58 04 04 02 18 08  00 ff 2f 00',
+            # A note of pitch 60 restruck before its note off, a note without length, and two
+            # overlapping notes of different pitches.
+            '00 90 3c 64  30 90 3c 50  30 80 3c 00  00 80 3c 00  00 90 40 64  00 80 40 00'
+            '  00 90 43 64  60 90 47 64  30 80 43 00  60 80 47 00  00 ff 2f 00'))
+        self.assertEqual([event.notes for event in song.tracks[0].measures[0]],
+                         [[Note(60, 100)], [Note(60, 80)], [Note(67, 100)],
+                          [Note(67, -1, True), Note(71, 100)], [Note(71, -1, True)]])
+
+    def test_import_time_signature_changes(self):
+        # At 96 ticks per beat: two 4/4 measures, one 3/4 measure, then 6/8 until a change to 2/4
+        # on the second beat of the second 6/8 measure. A single note lasts until the end.
+        song = self.import_like_pretty_midi(self.make_midi_data(
+            96,
+            '00 ff 58 04 04 02 18 08  86 00 ff 58 04 03 02 18 08  82 20 ff 58 04 06 03 18 08'
+            '  83 30 ff 58 04 02 02 18 08  00 ff 2f 00',
+            '00 90 3c 64  8e 00 80 3c 00  00 ff 2f 00'))
+        self.assertEqual([measure.time_signature for measure in song.tracks[0]],
+                         [TimeSignature(4, 4), TimeSignature(4, 4), TimeSignature(3, 4),
+                          TimeSignature(6, 8), TimeSignature(6, 8), TimeSignature(2, 4),
+                          TimeSignature(2, 4)])
+
+    def test_import_program_changes(self):
+        song = self.import_like_pretty_midi(self.make_midi_data(
+            96,
+            '00 ff 58 04 04 02 18 08  00 ff 2f 00',
+            # A program change between two notes on channel 0, and notes on channels 1 and 9.
+            '00 ff 03 04 4c 65 61 64  00 c0 00  00 90 3c 64  60 80 3c 00  00 c0 18  00 90 3e 64'
+            '  60 80 3e 00  00 c1 30  00 91 40 64  60 81 40 00  00 99 24 64  30 89 24 00'
+            '  00 ff 2f 00'))
+        self.assertEqual([(track.name, track.program, track.track_type) for track in song.tracks],
+                         [('Lead', 0, TrackType.UNKNOWN), ('Lead', 24, TrackType.UNKNOWN),
+                          ('Lead', 48, TrackType.UNKNOWN), ('Lead', 0, TrackType.DRUMS)])
 
     def test_instrument_is_monophonic(self):
         """Test is_monophonic function, True case."""
+        # pretty_midi is slow to import, so only import it in the tests that need it.
+        from pretty_midi import PrettyMIDI
+        from pysong.pretty_midi_utils import is_monophonic
+
         # Make mono song, convert to midi, load in pretty_midi, extract instrument.
         s_mono = self.make_song_monophonic()
-        filename = tempfile.mktemp() + '.mid'
-        SongMidiConverter.export_midi(s_mono, filename)
-        midi = PrettyMIDI(filename)
+        midi_buffer = io.BytesIO()
+        SongMidiConverter.export_midi(s_mono, midi_buffer)
+        midi_buffer.seek(0)
+        midi = PrettyMIDI(midi_buffer)
         instrument = midi.instruments[0]
         self.assertTrue(is_monophonic(instrument))
 
     def test_instrument_is_polyphonic(self):
         """Test is_monophonic function, False case."""
+        from pretty_midi import PrettyMIDI
+        from pysong.pretty_midi_utils import is_monophonic
+
         # Make poly song, convert to midi, load in pretty_midi, extract instrument.
         s_poly = self.make_song_polyphonic()
-        filename = tempfile.mktemp() + '.mid'
-        SongMidiConverter.export_midi(s_poly, filename)
-        midi = PrettyMIDI(filename)
+        midi_buffer = io.BytesIO()
+        SongMidiConverter.export_midi(s_poly, midi_buffer)
+        midi_buffer.seek(0)
+        midi = PrettyMIDI(midi_buffer)
         instrument = midi.instruments[0]
         self.assertFalse(is_monophonic(instrument))
 
@@ -371,39 +564,46 @@ class Test_song(unittest.TestCase):
         self.assertEqual(time_signatures[3].denominator, 8)
 
     def test_get_all_time_signatures(self):
+        from pretty_midi import PrettyMIDI
+        from pysong.pretty_midi_utils import get_all_time_signatures
+
         midifile = Test_song.create_midi_file_with_time_signatures()
 
-        tmp_midi_orig = tempfile.mktemp() + '.mid'
-        midifile.save(tmp_midi_orig)
+        midi_buffer = io.BytesIO()
+        midifile.save(file=midi_buffer)
 
-        pm = PrettyMIDI(tmp_midi_orig)
+        midi_buffer.seek(0)
+        pm = PrettyMIDI(midi_buffer)
         time_signatures = get_all_time_signatures(pm)
-        os.remove(tmp_midi_orig)
 
         self.verify_time_signatures(time_signatures)
 
     def test_export_time_signatures_midi(self):
-        # Create a midifile with time signature changes.
-        midifile = Test_song.create_midi_file_with_time_signatures()
-
-        tmp_midi_orig = tempfile.mktemp() + '.mid'
-        midifile.save(tmp_midi_orig)
-
-        # Load it into a Song object.
-        s = SongMidiConverter.create_song_from_midi(tmp_midi_orig)
+        # Load the midifile with time signature changes into a Song object, straight from the mido
+        # objects.
+        midifile = self.create_midi_file_with_time_signatures()
+        s = SongMidiConverter.create_song_from_mido(midifile)
 
         # Export to midi.
-        tmp_midi_new = tempfile.mktemp() + '.mid'
-        SongMidiConverter.export_midi(s, tmp_midi_new)
-
-        # Get time signatures from new MIDI file using PrettyMIDI.
-        pm = PrettyMIDI(tmp_midi_new)
-        time_signatures = get_all_time_signatures(pm)
-
-        os.remove(tmp_midi_orig)
-
-        # Verify time signatures.
-        self.verify_time_signatures(time_signatures)
+        midi_new = io.BytesIO()
+        SongMidiConverter.export_midi(s, midi_new)
+
+        # Get the time signature changes from the new MIDI file. At 4 ticks per beat, the two 4/4
+        # measures are 16 ticks long and the 3/4 measure 12 ticks.
+        midi_new.seek(0)
+        changes = []
+        tick = 0
+        for msg in MidiFile(file=midi_new).tracks[0]:
+            tick += msg.time
+            if msg.type == 'time_signature':
+                changes.append((tick, TimeSignature(msg.numerator, msg.denominator)))
+        self.assertEqual(changes, [(0, TimeSignature(4, 4)), (32, TimeSignature(3, 4)),
+                                   (44, TimeSignature(5, 8))])
+
+        # Verify the time signature of each measure when the new file is imported again.
+        midi_new.seek(0)
+        s_new = SongMidiConverter.create_song_from_midi(midi_new)
+        self.verify_time_signatures([measure.time_signature for measure in s_new.tracks[0]])
 
     def test_song_to_midi_to_song_ties_3(self):
         s = self.create_song_with_ties()